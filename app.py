@@ -1,4 +1,5 @@
 # app.py
+import multiprocessing
 from dash import Dash, html, dcc, Input, Output
 import dash_bootstrap_components as dbc
 from pages.intro_page import intro_layout
@@ -7,6 +8,8 @@ from pages.tabs import scrnaseq_cluster_tab
 from pages.tabs import scrnaseq_gene_tab
 from pages.tabs import visium_spatial_tab
 from pages.tabs import visium_deconv_tab
+from utils.png_cache import register_png_route
+from utils.bootstrap import start_startup_prefetch
 
 # ----------------------------------------
 app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP],
@@ -14,6 +17,13 @@ app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP],
 
 server = app.server
 
+# Large rendered plots are served from the PNG cache instead of inline data URIs
+register_png_route(server)
+
+# R pool workers are spawned and re-import this module; only the web process downloads data
+if multiprocessing.parent_process() is None:
+    start_startup_prefetch()
+
 app.layout = html.Div([
     dcc.Location(id="url", refresh=False),
     html.Div(id="page-content")
@@ -4,7 +4,7 @@ from dash import html, dcc, Input, Output, State
 from dotenv import load_dotenv
 import dash_bootstrap_components as dbc
 from utils.helper import get_dataset_options
-from utils.run_r_cluster_umap import generate_umap_plot
+from utils.run_r_cluster_umap import generate_umap_plots
 from utils.run_r_cluster_stat import generate_clusterStat_plots
 from utils.run_r_cluster_perSubject import generate_PerSubject_StackBar_plots
 
@@ -114,11 +114,13 @@ def register_callbacks(app):
         clusters_to_filter = [] if not selected_clusters or 'All' in selected_clusters else selected_clusters
         subjects_to_filter = [] if not selected_subjects or 'All' in selected_subjects else selected_subjects
         
-        # Pass the selected clusters and subjects to the plotting function
-        src_all = generate_umap_plot(dataset_prefix, "All", "All Timepoints", clusters_to_filter, subjects_to_filter)
-        src_prior = generate_umap_plot(dataset_prefix, "Prior", "Prior", clusters_to_filter, subjects_to_filter)
-        src_lesion = generate_umap_plot(dataset_prefix, "Lesion", "Lesion", clusters_to_filter, subjects_to_filter)
-        src_post = generate_umap_plot(dataset_prefix, "Post", "Post", clusters_to_filter, subjects_to_filter)
+        # Pass the selected clusters and subjects to the plotting function; panels render in parallel
+        src_all, src_prior, src_lesion, src_post = generate_umap_plots(
+            dataset_prefix,
+            [("All", "All Timepoints"), ("Prior", "Prior"), ("Lesion", "Lesion"), ("Post", "Post")],
+            clusters_to_filter,
+            subjects_to_filter,
+        )
         
         stats_plot_src = generate_clusterStat_plots(dataset_prefix)
 
@@ -15,10 +15,11 @@ from utils.gene_utils import (set_refresh_flag, get_refresh_flag,
                              log_progress)
 from utils.run_gex_data_loader import load_filtered_gex_data
 from utils.run_pert_data_loader import load_filtered_pert_data
-from utils.run_r_gene_umap import generate_feature_umap_from_df
-from utils.run_r_gene_heatmap import generate_heatmap_from_df
+from utils.run_r_gene_umap import generate_feature_umap_from_df, submit_feature_umap
+from utils.run_r_gene_heatmap import generate_heatmap_from_df, submit_heatmap
 from utils.run_r_gene_violin_plot import generate_violin_plot_from_df
-from utils.run_r_gene_dot_plot import generate_dot_plot_from_df
+from utils.run_r_gene_dot_plot import generate_dot_plot_from_df, submit_dot_plot
+from utils.r_pool import r_task_result
 
 # Load environment variables from .env file
 load_dotenv()
@@ -250,10 +251,15 @@ def register_callbacks(app):
                     force_s3=True
                 )
 
-                umap_src, _ = generate_feature_umap_from_df(data_gex, genes_available)
-                heatmap_src, _ = generate_heatmap_from_df(data_gex, color_map, genes_available)
+                # UMAP, heatmap and dot plot render on the R worker pool while the violin runs here
+                umap_future = submit_feature_umap(data_gex, genes_available)
+                heatmap_future = submit_heatmap(data_gex, color_map, genes_available)
+                dot_future = submit_dot_plot(data_pert, data_gex, color_map, genes_available, clusters_to_filter)
+
                 violin_src, _ = generate_violin_plot_from_df(data_gex, color_map, genes_available)
-                dot_src, _ = generate_dot_plot_from_df(data_pert, data_gex, color_map, genes_available, clusters_to_filter)
+                umap_src, _ = r_task_result(umap_future, generate_feature_umap_from_df, data_gex, genes_available)
+                heatmap_src, _ = r_task_result(heatmap_future, generate_heatmap_from_df, data_gex, color_map, genes_available)
+                dot_src, _ = r_task_result(dot_future, generate_dot_plot_from_df, data_pert, data_gex, color_map, genes_available, clusters_to_filter)
                 
             except Exception as e:
                 log_progress(f"Error generating plots: {e}")
@@ -330,10 +336,15 @@ def register_callbacks(app):
                 force_s3=True
             )
 
-            umap_src, _ = generate_feature_umap_from_df(data_gex, final_genes)
-            heatmap_src, _ = generate_heatmap_from_df(data_gex, color_map, final_genes)
+            # UMAP, heatmap and dot plot render on the R worker pool while the violin runs here
+            umap_future = submit_feature_umap(data_gex, final_genes)
+            heatmap_future = submit_heatmap(data_gex, color_map, final_genes)
+            dot_future = submit_dot_plot(data_pert, data_gex, color_map, final_genes, clusters_to_filter)
+
             violin_src, _ = generate_violin_plot_from_df(data_gex, color_map, final_genes)
-            dot_src, _ = generate_dot_plot_from_df(data_pert, data_gex, color_map, final_genes, clusters_to_filter)
+            umap_src, _ = r_task_result(umap_future, generate_feature_umap_from_df, data_gex, final_genes)
+            heatmap_src, _ = r_task_result(heatmap_future, generate_heatmap_from_df, data_gex, color_map, final_genes)
+            dot_src, _ = r_task_result(dot_future, generate_dot_plot_from_df, data_pert, data_gex, color_map, final_genes, clusters_to_filter)
 
             msg = f"New genes added for {dataset_prefix}. Plots updated."
 
@@ -0,0 +1,35 @@
+# utils/bootstrap.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Startup downloads (large RData files) run here so they overlap with each other and
+# with the rest of app start-up instead of blocking the import chain one after another
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="s3_prefetch")
+_prefetches = {}
+_prefetch_lock = threading.Lock()
+
+def prefetch(fn):
+    """
+    Starts fn() in the background the first time it is requested and returns its Future.
+    Modules call this at import to begin a download early, then prefetch(fn).result()
+    right before they need the file; exceptions surface from result() as usual.
+    """
+    with _prefetch_lock:
+        future = _prefetches.get(fn)
+        # A failed prefetch is retried on the next request instead of failing forever
+        if future is None or (future.done() and future.exception() is not None):
+            future = _prefetch_pool.submit(fn)
+            _prefetches[fn] = future
+        return future
+
+def start_startup_prefetch():
+    """
+    Begins the large Visium downloads in the background. Called by app.py in the web
+    process only; importing the plot modules no longer starts any download, so spawned
+    R pool workers (which re-import the app) never repeat this work.
+    """
+    from utils.run_r_spatial_gene import ensure_visium_data_exists
+    from utils.run_r_spatial_deconvo import download_deconvo_rdata
+    prefetch(ensure_visium_data_exists)
+    prefetch(download_deconvo_rdata)
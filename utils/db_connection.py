@@ -46,15 +46,3 @@ def configure_duckdb_s3(con):
 
     except Exception as e:
         print(f"Failed to configure DuckDB S3: {e}")
-
-def dict_to_r_vector(py_dict):
-    """
-    Converts Python dict: {'Cluster A': '#FF0000', 'Cluster B': '#00FF00'} 
-    To R string: 'c("Cluster A"="#FF0000", "Cluster B"="#00FF00")'
-    """
-    if not py_dict or not isinstance(py_dict, dict):
-        return "NULL"
-    
-    # Format as "key"="value", safely quoting both sides
-    items = [f'"{str(k)}"="{str(v)}"' for k, v in py_dict.items()]
-    return f"c({', '.join(items)})"
@@ -0,0 +1,155 @@
+import os
+import glob
+import json
+import duckdb
+import datetime
+import boto3
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+# --- Configuration ---
+DATA_PATH = "DataWarehouse/Pert"
+TARGETS = ["tcell", "myeloid"] # Prefixes to process
+LOG_FILE = "DataWarehouse/logs/highlighted_matrix.log"
+
+# Curated gene list; override per deployment with DataWarehouse/Pert/highlighted_genes.json
+HIGHLIGHTED_GENES_FILE = os.path.join(DATA_PATH, "highlighted_genes.json")
+DEFAULT_HIGHLIGHTED_GENES = ['CD4', 'CD8A', 'CD14', 'FCGR3A', 'IFNG', 'PRF1', 'GZMA', 'GZMB']
+MAX_HIGHLIGHTED_GENES = 200
+ROW_GROUP_SIZE = 32000
+S3_PERT_PREFIX = "Joe/HSV_Dashboard_py/DataWarehouse/Pert" # Where run_pert_data_loader looks in S3 mode
+
+def log(msg):
+    """Logs a message to stdout and to the log file."""
+    ts = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    line = f"[{ts}] {msg}"
+    print(line)
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    with open(LOG_FILE, "a") as f:
+        f.write(line + "\n")
+
+def safe_path(p):
+    """Helper to ensure file paths have forward slashes for DuckDB SQL."""
+    return p.replace(os.sep, '/')
+
+JOIN_KEYS = ["Subject", "CellType_Level3", "Status"]
+
+def load_highlighted_genes():
+    """Returns the curated gene list (JSON override if present), capped at MAX_HIGHLIGHTED_GENES."""
+    genes = DEFAULT_HIGHLIGHTED_GENES
+    if os.path.exists(HIGHLIGHTED_GENES_FILE):
+        with open(HIGHLIGHTED_GENES_FILE, 'r') as f:
+            genes = json.load(f)
+    return list(dict.fromkeys(genes))[:MAX_HIGHLIGHTED_GENES]
+
+def upload_to_s3(local_path):
+    """
+    Uploads the built matrix to S3_PERT_PREFIX. The dashboard loads Pert data from S3,
+    so without this step its fast path never sees the file. Skipped (with a log line)
+    when S3_BUCKET_URI is not set.
+    """
+    bucket_uri = os.getenv("S3_BUCKET_URI")
+    if not bucket_uri:
+        log(f"S3_BUCKET_URI not set; {os.path.basename(local_path)} was NOT uploaded to S3.")
+        return
+
+    bucket = urlparse(bucket_uri).netloc if bucket_uri.startswith("s3://") else bucket_uri
+    key = f"{S3_PERT_PREFIX}/{os.path.basename(local_path)}"
+    try:
+        boto3.client("s3").upload_file(local_path, bucket, key)
+        log(f"Uploaded to s3://{bucket}/{key}")
+    except Exception as e:
+        log(f"S3 UPLOAD FAILED for {os.path.basename(local_path)}: {e}")
+
+def build_highlighted_matrix(prefix, genes):
+    """
+    Join every Pert shard once for the curated genes and write
+    {prefix}_highlighted_matrix.parquet (locally, then to S3), so
+    load_filtered_pert_data can answer common queries with a single
+    read_parquet and no JOINs.
+    """
+    log(f"--- Building highlighted matrix for {prefix} ---")
+
+    # --- 1. Identify Core and Extension Files ---
+    core_path = os.path.join(DATA_PATH, f"{prefix}_pert_core.parquet")
+    if not os.path.exists(core_path):
+        log(f"No core file found for {prefix}. Skipping.")
+        return
+
+    pattern = os.path.join(DATA_PATH, f"{prefix}_pert_*.parquet")
+    # Sorted, as in the loader's shard discovery, so "first file wins" picks the same file
+    ext_files = sorted(f for f in glob.glob(pattern) if os.path.normpath(f) != os.path.normpath(core_path))
+
+    output_path = os.path.join(DATA_PATH, f"{prefix}_highlighted_matrix.parquet")
+    temp_output_path = output_path + ".tmp"
+
+    con = duckdb.connect()
+    try:
+        # --- 2. Map each requested gene to the first file that provides it ---
+        core_cols = set(con.execute(f"DESCRIBE SELECT * FROM read_parquet('{safe_path(core_path)}')").df()['column_name'])
+        gene_to_alias = {g: 'core' for g in genes if g in core_cols}
+
+        join_clauses_sql = []
+        for i, f_path in enumerate(ext_files):
+            alias = f't{i}'
+            ext_cols = set(con.execute(f"DESCRIBE SELECT * FROM read_parquet('{safe_path(f_path)}')").df()['column_name'])
+            if not all(k in ext_cols for k in JOIN_KEYS):
+                log(f"Skipping {os.path.basename(f_path)} — missing join keys.")
+                continue
+
+            new_genes = [g for g in genes if g in ext_cols and g not in gene_to_alias]
+            if not new_genes:
+                continue
+
+            for g in new_genes:
+                gene_to_alias[g] = alias
+            join_condition = " AND ".join([f"core.{k} = {alias}.{k}" for k in JOIN_KEYS])
+            join_clauses_sql.append(
+                f"LEFT JOIN read_parquet('{safe_path(f_path)}') AS {alias} ON {join_condition}"
+            )
+            log(f"Adding {len(new_genes)} highlighted genes from {os.path.basename(f_path)}")
+
+        missing = [g for g in genes if g not in gene_to_alias]
+        if missing:
+            log(f"Highlighted genes not found in any file (left out): {missing}")
+        if not gene_to_alias:
+            log(f"None of the highlighted genes exist for {prefix}. Skipping.")
+            return
+
+        # --- 3. Write the matrix sorted by key so row groups stay selective ---
+        select_sql = ", ".join(
+            [f"core.{k}" for k in JOIN_KEYS] +
+            [f'{alias}."{g}"' for g, alias in gene_to_alias.items()]
+        )
+        query = f"""
+        COPY (
+            SELECT {select_sql}
+            FROM read_parquet('{safe_path(core_path)}') AS core
+            {' '.join(join_clauses_sql)}
+            ORDER BY {', '.join(f'core.{k}' for k in JOIN_KEYS)}
+        ) TO '{safe_path(temp_output_path)}' (FORMAT 'parquet', CODEC 'zstd', ROW_GROUP_SIZE {ROW_GROUP_SIZE});
+        """
+        con.execute(query)
+        con.close()
+
+        # --- 4. Atomic Replace ---
+        os.replace(temp_output_path, output_path)
+        log(f"Saved {os.path.basename(output_path)} with {len(gene_to_alias)} genes.")
+        upload_to_s3(output_path)
+
+    except Exception as e:
+        log(f"CRITICAL BUILD FAILED for {prefix}: {e}")
+        con.close()
+        if os.path.exists(temp_output_path):
+            os.remove(temp_output_path)
+
+if __name__ == "__main__":
+    load_dotenv()
+    genes = load_highlighted_genes()
+    log(f"--- Highlighted Matrix Build STARTING ({len(genes)} genes) ---")
+    for prefix in TARGETS:
+        try:
+            build_highlighted_matrix(prefix, genes)
+        except Exception as e:
+            log(f"Unhandled error for {prefix}: {e}")
+    log("--- Highlighted Matrix Build FINISHED ---")
@@ -5,6 +5,7 @@ import boto3
 import datetime
 import subprocess
 from urllib.parse import urlparse
+from utils.run_pert_data_loader import clear_shard_cache
 
 # --- Data Caching ---
 OPTIONS_CACHE = {} # Cache for dropdown options (clusters, subjects)
@@ -198,6 +199,9 @@ def run_precompute_r_async(dataset_prefix, genes_to_extract):
                         del GENE_LIST_CACHE[dataset_prefix]
                     log_progress(f"🧹 Cleared gene list cache for {dataset_prefix}")
 
+                    # New Pert shards just landed; force a fresh file discovery
+                    clear_shard_cache(dataset_prefix)
+
                     set_refresh_flag(dataset_prefix, "ready") 
                 else:
                     log_progress(f"R job exited with code {proc.returncode} for {dataset_prefix}")
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import boto3
 from io import BytesIO
 import pandas as pd
@@ -56,3 +57,21 @@ def get_dataset_options(dataset_prefix, bucket_name=None, force_s3=False):
             return {"clusters": [], "subjects": []}
 
     return OPTIONS_CACHE[dataset_prefix]
+
+def frame_fingerprint(df):
+    """
+    Content hash of a DataFrame for memo keys. id() is unusable here: every callback
+    reloads fresh frames and CPython recycles ids, so a stale entry could be served.
+    """
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    digest = hashlib.sha1(row_hashes.tobytes())
+    digest.update("|".join(map(str, df.columns)).encode("utf-8"))
+    return digest.hexdigest()
+
+def file_signature(path):
+    """Size and mtime of a file as a dict (JSON-friendly, usable in cache keys), or None if absent."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
@@ -0,0 +1,91 @@
+# utils/png_cache.py
+
+import hashlib
+import os
+import re
+import tempfile
+
+PNG_CACHE_DIR = os.getenv("PNG_CACHE_DIR", os.path.join(tempfile.gettempdir(), "hsv_png_cache"))
+PNG_CACHE_MAX_FILES = 512 # Oldest (least recently read) PNGs are pruned past this
+PNG_ROUTE_PREFIX = "/plot/"
+
+_KEY_PATTERN = re.compile(r"[0-9a-f]{32}") # png_cache_key output; anything else is rejected by the route
+
+def png_cache_key(*parts):
+    """Hashes the plot inputs (frame fingerprint, genes, colors, ...) into a cache file name."""
+    return hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+def png_cache_get(key):
+    """
+    Returns the cached PNG bytes for key, or None. The file's mtime is bumped on a hit
+    so pruning evicts the least recently used plots first.
+    """
+    path = os.path.join(PNG_CACHE_DIR, f"{key}.png")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except OSError:
+        return None
+
+def png_cache_has(key):
+    """Returns True if a PNG is cached under key, bumping its mtime like a read would."""
+    try:
+        os.utime(os.path.join(PNG_CACHE_DIR, f"{key}.png"))
+        return True
+    except OSError:
+        return False
+
+def png_cache_put(key, png_bytes):
+    """
+    Stores PNG bytes under key. The file is written aside and moved into place, so
+    concurrent workers never read a partial PNG. Cache failures are logged, never raised;
+    the return value says whether the PNG was stored.
+    """
+    try:
+        os.makedirs(PNG_CACHE_DIR, exist_ok=True)
+        path = os.path.join(PNG_CACHE_DIR, f"{key}.png")
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(png_bytes)
+        os.replace(tmp_path, path)
+        _prune_png_cache()
+        return True
+    except OSError as e:
+        print(f"PNG cache write failed: {e}")
+        return False
+
+def png_cache_url(key):
+    """URL under which register_png_route serves the cached PNG for key."""
+    return f"{PNG_ROUTE_PREFIX}{key}"
+
+def register_png_route(server):
+    """
+    Adds a Flask route serving cached PNGs straight from disk, so large plots reach the
+    browser as plain image responses instead of base64 text inside the callback JSON.
+    Keys hash the plot inputs, not the PNG bytes; the browser may cache a response for an
+    hour, which is only safe because callers put the data version into the key.
+    """
+    from flask import abort, send_file
+
+    @server.route(f"{PNG_ROUTE_PREFIX}<token>")
+    def serve_cached_png(token):
+        if not _KEY_PATTERN.fullmatch(token):
+            abort(404)
+        path = os.path.join(PNG_CACHE_DIR, f"{token}.png")
+        if not os.path.exists(path):
+            abort(404)
+        return send_file(path, mimetype="image/png", max_age=3600)
+
+def _prune_png_cache():
+    """Deletes the least recently used PNGs once the cache holds more than PNG_CACHE_MAX_FILES."""
+    entries = [e for e in os.scandir(PNG_CACHE_DIR) if e.name.endswith(".png")]
+    if len(entries) <= PNG_CACHE_MAX_FILES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - PNG_CACHE_MAX_FILES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
@@ -0,0 +1,107 @@
+# utils/r_pool.py
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+def _default_pool_workers():
+    """
+    R sessions per web worker. A request submits at most 3 R tasks, and the host's cores are
+    shared by every gunicorn worker, each with its own pool (WEB_CONCURRENCY is the worker
+    count gunicorn reads), so 4 web workers on 8 cores get 2 R sessions each, not 3.
+    """
+    web_workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    return max(1, min(3, (os.cpu_count() or 1) // web_workers))
+
+R_POOL_WORKERS = int(os.getenv("R_POOL_WORKERS") or _default_pool_workers())
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _init_r_session():
+    """
+    Worker initializer: starts the worker's embedded R before its first task. Each plot
+    module attaches its packages and compiles its render function when the task that
+    uses it is unpickled (which imports the module), and keeps that state afterwards.
+    """
+    import rpy2.robjects as ro
+    ro.r("invisible(NULL)")
+
+def get_r_pool():
+    """Lazily starts the shared pool of R worker processes."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn gives every worker its own embedded R; forking a live R session is unsafe
+            _pool = ProcessPoolExecutor(
+                max_workers=R_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_r_session,
+            )
+        return _pool
+
+def reset_r_pool():
+    """Discards a broken pool so the next submission starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+def submit_r_task(fn, *args):
+    """
+    Submits fn(*args) to the R worker pool. If the pool cannot take work, the task
+    runs in-process and an already-completed Future is returned instead.
+    """
+    try:
+        return get_r_pool().submit(fn, *args)
+    except Exception as e:
+        print(f"R worker pool unavailable ({e}); running task in-process.")
+        reset_r_pool()
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+def r_task_result(future, fallback, *args):
+    """Waits for a pooled task; if its worker died, renders in-process with fallback(*args)."""
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        print(f"R worker pool failed ({e}); rendering in-process.")
+        reset_r_pool()
+        return fallback(*args)
+
+def df_to_ipc(df):
+    """Serializes a DataFrame as an Arrow IPC stream; far cheaper to ship to a worker than a pickled frame."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def ipc_to_df(buf):
+    """Reads an Arrow IPC stream produced by df_to_ipc back into a DataFrame."""
+    return pa.ipc.open_stream(buf).read_all().to_pandas()
+
+def narrow_columns(df, columns):
+    """
+    Returns df with the given float columns stored compactly for IPC. Columns holding only
+    whole numbers in 0-255 (e.g. percent or 0/1 flags) become uint8, which is lossless;
+    anything else becomes float32, which is ample for log-normalized expression.
+    """
+    narrowed = {}
+    for col in columns:
+        if col not in df.columns or not pd.api.types.is_float_dtype(df[col].dtype):
+            continue
+        values = df[col].to_numpy()
+        if (np.isfinite(values).all() and (values >= 0).all() and (values <= 255).all()
+                and (values == np.round(values)).all()):
+            narrowed[col] = values.astype(np.uint8)
+        elif values.dtype != np.float32:
+            narrowed[col] = values.astype(np.float32)
+    return df.assign(**narrowed) if narrowed else df
@@ -0,0 +1,65 @@
+# utils/r_utils.py
+
+import binascii
+import functools
+import pyarrow as pa
+import rpy2.robjects as ro
+from rpy2_arrow.arrow import pyarrow_table_to_r_table
+
+# R helpers shared by the plot modules. Graphics devices can only target files, so each
+# R session keeps one scratch PNG path for its lifetime (R's per-session tempdir is removed
+# on exit); renders overwrite it and return the bytes, and Python never touches the file.
+# The embedded R runs one call at a time, so a single path per session cannot collide.
+ro.r("""
+    .png_scratch <- tempfile(pattern = "plot_", fileext = ".png")
+
+    .read_png_scratch <- function() {
+        readBin(.png_scratch, what = "raw", n = file.info(.png_scratch)$size)
+    }
+
+    .ggsave_raw <- compiler::cmpfun(function(p, width, height, dpi, ...) {
+        # ragg's AGG rasterizer is considerably faster than the default Cairo png device
+        ggplot2::ggsave(.png_scratch, plot = p, width = width, height = height, dpi = dpi, device = ragg::agg_png, ...)
+        .read_png_scratch()
+    })
+""")
+
+_PNG_URI_PREFIX = "data:image/png;base64,"
+
+def df_to_r_arrow(df):
+    """
+    Hands a pandas DataFrame (or pyarrow Table) to R as an arrow::Table.
+    The buffers are shared over the Arrow C Data Interface instead of being
+    copied cell-by-cell like pandas2ri; use as.data.frame() on the R side.
+    """
+    table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False)
+    return pyarrow_table_to_r_table(table)
+
+def r_named_colors(colors):
+    """
+    Converts a {label: hex} color map into a named R character vector, the form
+    scale_*_manual(values = ...) expects, without a JSON round trip or R parsing.
+    """
+    if not colors or not isinstance(colors, dict):
+        return ro.NULL
+    vec = ro.StrVector([str(v) for v in colors.values()])
+    vec.names = ro.StrVector([str(k) for k in colors.keys()])
+    return vec
+
+def png_data_uri(r_raw):
+    """Encodes an R raw vector (or bytes) holding PNG bytes as a data URI for html.Img."""
+    return _PNG_URI_PREFIX + binascii.b2a_base64(bytes(r_raw), newline=False).decode("ascii")
+
+@functools.lru_cache(maxsize=None)
+def no_data_png(width, height, dpi):
+    """
+    Renders the "No data for selection" placeholder once per size and caches the data URI,
+    so empty filter results are answered without another trip into R.
+    """
+    png_raw = ro.r(f"""
+        .ggsave_raw(ggplot2::ggplot() +
+                        ggplot2::annotate("text", x = 0, y = 0, label = "No data for selection") +
+                        ggplot2::theme_void(),
+                    width = {width}, height = {height}, dpi = {dpi})
+    """)
+    return png_data_uri(png_raw)
@@ -20,6 +20,12 @@ s3_client = boto3.client('s3')
 # --- Key Columns for this dataset ---
 KEY_COLS = {"Subject", "CellType_Level3", "Status"}
 
+# --- Shard Discovery Caching ---
+SHARD_CACHE = {} # (dataset_prefix, use_s3) -> {"core_path", "ext_files", "timestamp"}
+SHARD_CACHE_TTL = 300 # seconds before a glob / S3 LIST is repeated
+HIGHLIGHTED_CACHE = {} # (dataset_prefix, use_s3) -> {"matrix_path", "genes", "timestamp"}
+S3_PERT_PREFIX = "Joe/HSV_Dashboard_py/DataWarehouse/Pert"
+
 def safe_path(p):
     """Helper to ensure file paths have forward slashes for DuckDB SQL."""
     return p.replace(os.sep, '/')
@@ -30,6 +36,129 @@ def read_schema_duckdb(path):
     con.close()
     return set(df["column_name"])
 
+def read_schema_duckdb_con(con, path):
+    """Same as read_schema_duckdb, but on an existing (e.g. S3-configured) connection."""
+    df = con.execute(f"DESCRIBE SELECT * FROM read_parquet('{safe_path(path)}')").df()
+    return set(df["column_name"])
+
+def _assert_pushdown(con, sql, has_filters, n_selected):
+    """
+    Dev guard (HSV_EXPLAIN=1): runs EXPLAIN ANALYZE on the query and fails loudly
+    if the Parquet scans lost filter pushdown or read more columns than selected.
+    """
+    plan = con.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}").fetchall()
+    nodes = json.loads(plan[0][1])
+    stack = nodes if isinstance(nodes, list) else [nodes]
+
+    # Collect every Parquet scan node in the plan tree
+    scans = []
+    while stack:
+        node = stack.pop()
+        name = node.get("operator_name") or node.get("name") or ""
+        extra = node.get("extra_info") or {}
+        if "PARQUET" in name or (isinstance(extra, dict) and extra.get("Function") == "READ_PARQUET"):
+            scans.append(extra if isinstance(extra, dict) else {"raw": extra})
+        stack.extend(node.get("children", []))
+
+    offenders = []
+    if has_filters and not any(scan.get("Filters") or "Filters:" in scan.get("raw", "") for scan in scans):
+        offenders.append("WHERE clause present but no Parquet scan reports pushed-down Filters")
+
+    # Join keys are allowed on top of the selected columns
+    max_cols = n_selected + len(KEY_COLS)
+    for scan in scans:
+        projections = scan.get("Projections") or []
+        if isinstance(projections, str):
+            projections = projections.split("\n")
+        if len(projections) > max_cols:
+            offenders.append(f"{scan.get('Filename(s)', 'parquet scan')} projects {len(projections)} columns (> {max_cols})")
+
+    for offender in offenders:
+        print(f"Warning: pushdown check failed: {offender}")
+    if offenders:
+        raise AssertionError(f"Parquet pushdown regression: {'; '.join(offenders)}")
+
+def clear_shard_cache(dataset_prefix=None):
+    """Drop cached shard listings (all datasets, or just one) so new shards are picked up."""
+    for cache in (SHARD_CACHE, HIGHLIGHTED_CACHE):
+        if dataset_prefix is None:
+            cache.clear()
+            continue
+        for key in [k for k in cache if k[0] == dataset_prefix]:
+            del cache[key]
+
+def _discover_shards(dataset_prefix, use_s3, actual_bucket=None):
+    """
+    Returns (core_path, ext_files) for a dataset, memoized for SHARD_CACHE_TTL seconds
+    so hot callbacks skip the glob (local) or list_objects_v2 round trip (S3).
+    """
+    # 0. Check Cache First (Fast return)
+    cache_key = (dataset_prefix, use_s3)
+    cached = SHARD_CACHE.get(cache_key)
+    if cached and time.time() - cached["timestamp"] < SHARD_CACHE_TTL:
+        return cached["core_path"], cached["ext_files"]
+
+    if use_s3:
+        # S3: Core file path
+        core_path = f"s3://{actual_bucket}/{S3_PERT_PREFIX}/{dataset_prefix}_pert_core.parquet"
+
+        # S3: List objects to find core and extension files (errors propagate to the caller)
+        response = s3_client.list_objects_v2(Bucket=actual_bucket,
+                                             Prefix=f"{S3_PERT_PREFIX}/{dataset_prefix}_pert_*.parquet")
+        all_files = [obj['Key']
+                     for obj in response.get('Contents', [])
+                     if obj['Key'].startswith(f"{S3_PERT_PREFIX}/{dataset_prefix}_pert_*.parquet")]
+        core_key = f"{S3_PERT_PREFIX}/{dataset_prefix}_pert_core.parquet"
+        ext_files = sorted(key for key in all_files if key != core_key)
+    else:
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        local_pert_dir = os.path.join(project_root, "DataWarehouse", "Pert")
+        core_path = os.path.join(local_pert_dir, f"{dataset_prefix}_gex_core.parquet")
+
+        # Local: Find extension files using Glob
+        all_files_pattern = os.path.join(local_pert_dir, f"{dataset_prefix}_pert_*.parquet")
+        all_files = glob.glob(all_files_pattern)
+        ext_files = sorted(f for f in all_files if os.path.normpath(f) != os.path.normpath(core_path))
+
+    SHARD_CACHE[cache_key] = {
+        "core_path": core_path,
+        "ext_files": ext_files,
+        "timestamp": time.time(),
+    }
+    return core_path, ext_files
+
+def _highlighted_matrix(con, dataset_prefix, use_s3, actual_bucket=None):
+    """
+    Returns (matrix_path, genes) for the pre-joined highlighted matrix written by
+    extra_build_highlighted_matrix.py, or (None, set()) when it does not exist.
+    Cached alongside the shard listing.
+    """
+    cache_key = (dataset_prefix, use_s3)
+    cached = HIGHLIGHTED_CACHE.get(cache_key)
+    if cached and time.time() - cached["timestamp"] < SHARD_CACHE_TTL:
+        return cached["matrix_path"], cached["genes"]
+
+    if use_s3:
+        matrix_path = f"s3://{actual_bucket}/{S3_PERT_PREFIX}/{dataset_prefix}_highlighted_matrix.parquet"
+    else:
+        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+        matrix_path = os.path.join(project_root, "DataWarehouse", "Pert", f"{dataset_prefix}_highlighted_matrix.parquet")
+
+    genes = set()
+    if use_s3 or os.path.exists(matrix_path):
+        try:
+            genes = read_schema_duckdb_con(con, matrix_path) - KEY_COLS
+        except Exception:
+            # No matrix for this dataset; every query takes the JOIN path
+            genes = set()
+
+    HIGHLIGHTED_CACHE[cache_key] = {
+        "matrix_path": matrix_path if genes else None,
+        "genes": genes,
+        "timestamp": time.time(),
+    }
+    return HIGHLIGHTED_CACHE[cache_key]["matrix_path"], genes
+
 def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=None, bucket_name=None, force_s3=False):
     """
     Loads and JOINS filtered Pert data from multiple Parquet files
@@ -47,8 +176,6 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
     if bucket_uri.startswith("s3://"):
         actual_bucket = urlparse(bucket_uri).netloc
 
-    s3_prefix = "Joe/HSV_Dashboard_py/DataWarehouse/Pert"
-
     # Local Path Definitions
     local_pert_dir = os.path.join(project_root, "DataWarehouse", "Pert")
     local_core_path = os.path.join(local_pert_dir, f"{dataset_prefix}_gex_core.parquet")
@@ -63,12 +190,9 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
     if not force_s3 and os.path.exists(local_core_path):
         print(f"Using LOCAL Pert files from: {local_pert_dir}")
         use_s3 = False
-        core_path = local_core_path
 
-        # Local: Find extension files using Glob
-        all_files_pattern = os.path.join(local_pert_dir, f"{dataset_prefix}_pert_*.parquet")
-        all_files = glob.glob(all_files_pattern)
-        ext_files = [f for f in all_files if os.path.normpath(f) != os.path.normpath(local_core_path)]
+        # Local: Find core and extension files (cached glob)
+        core_path, ext_files = _discover_shards(dataset_prefix, use_s3)
         
         # Local: Load Colors
         color_path = os.path.join(project_root, "DataWarehouse/Color", f"{dataset_prefix}_colors.json")
@@ -84,18 +208,9 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
         print(f"Using S3 Pert files from bucket: {actual_bucket}")
         use_s3 = True
 
-        # S3: Core file path
-        core_path = f"s3://{actual_bucket}/{s3_prefix}/{dataset_prefix}_pert_core.parquet"
-
         try: 
-            # S3: List objects to find core and extension files
-            response = s3_client.list_objects_v2(Bucket=actual_bucket, 
-                                                 Prefix=f"{s3_prefix}/{dataset_prefix}_pert_*.parquet")
-            all_files = [obj['Key'] 
-                         for obj in response.get('Contents', []) 
-                         if obj['Key'].startswith(f"{s3_prefix}/{dataset_prefix}_pert_*.parquet")]
-            core_key = f"{s3_prefix}/{dataset_prefix}_pert_core.parquet"
-            ext_files = [key for key in all_files if key != core_key]
+            # S3: Find core and extension files (cached LIST)
+            core_path, ext_files = _discover_shards(dataset_prefix, use_s3, actual_bucket)
 
         except Exception as e:
             print(f"Error listing S3 files: {e}")
@@ -115,7 +230,45 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
 
     if use_s3:
         configure_duckdb_s3(con)
-    
+
+    # Build WHERE clause (filtering on the 'core' table's metadata)
+    where_clauses = ["1=1"]
+    if clusters: # 'clusters' maps to 'CellType_Level3'
+        cluster_sql_list = ", ".join([f"'{c}'" for c in clusters])
+        where_clauses.append(f'core."CellType_Level3" IN ({cluster_sql_list})')
+    if subjects:
+        subject_sql_list = ", ".join([f"'{s}'" for s in subjects])
+        where_clauses.append(f'core."Subject" IN ({subject_sql_list})')
+
+    # --- Fast Path: every requested gene lives in the pre-joined highlighted matrix ---
+    # extra_build_highlighted_matrix.py writes it to DataWarehouse/Pert and uploads it to
+    # S3_PERT_PREFIX when S3_BUCKET_URI is set; S3 mode only finds it after that upload
+    if genes:
+        requested = genes if isinstance(genes, list) else [genes]
+        matrix_path, highlighted_genes = _highlighted_matrix(con, dataset_prefix, use_s3, actual_bucket if use_s3 else None)
+        if matrix_path and set(requested).issubset(highlighted_genes):
+            select_list = [f'core."{col}"' for col in sorted(KEY_COLS)] + [f'core."{g}"' for g in dict.fromkeys(requested)]
+            fast_sql = f"""
+            SELECT
+                {', '.join(select_list)}
+            FROM read_parquet('{safe_path(matrix_path)}') AS core
+            WHERE
+                {' AND '.join(where_clauses)}
+            """
+            try:
+                if os.getenv("HSV_EXPLAIN"):
+                    _assert_pushdown(con, fast_sql, len(where_clauses) > 1, len(select_list))
+                df = con.execute(fast_sql).df()
+                print(f"Served {df.shape[0]:,} rows × {df.shape[1]} cols from {os.path.basename(matrix_path)} (no JOINs)")
+                print(f"load_filtered_pert_data() completed in {time.time() - start_time:.2f} seconds.")
+                con.close()
+                return df, color_map
+            except AssertionError:
+                con.close()
+                raise
+            except Exception as e:
+                print(f"Highlighted matrix query failed, falling back to JOIN path: {e}")
+
     try:
         core_schema_df = con.execute(f"DESCRIBE SELECT * FROM read_parquet('{safe_path(core_path)}')").df()
         core_cols = set(core_schema_df['column_name'])
@@ -154,8 +307,9 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
                 print(f"Skipping {os.path.basename(file_path)}: Missing one or more keys.")
                 continue
             
-            # Find all potential new gene columns
-            potential_new_cols = ext_cols - core_cols - KEY_COLS
+            # Find all potential new gene columns; a gene found in an earlier file keeps
+            # that file (same rule as extra_build_highlighted_matrix.py, so both paths agree)
+            potential_new_cols = ext_cols - col_to_table_map.keys() - KEY_COLS
             
             # Figure out which of these we actually need to join
             if genes:
@@ -215,15 +369,6 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
     if missing_cols:
         print(f"Warning: Requested genes not found in any file: {missing_cols}")
 
-    # Build WHERE clause (filtering on the 'core' table's metadata)
-    where_clauses = ["1=1"]
-    if clusters: # 'clusters' maps to 'CellType_Level3'
-        cluster_sql_list = ", ".join([f"'{c}'" for c in clusters])
-        where_clauses.append(f'core."CellType_Level3" IN ({cluster_sql_list})')
-    if subjects:
-        subject_sql_list = ", ".join([f"'{s}'" for s in subjects])
-        where_clauses.append(f'core."Subject" IN ({subject_sql_list})')
-
     # --- 5. Assemble and Execute Final Query ---
     final_sql = f"""
     SELECT
@@ -239,9 +384,14 @@ def load_filtered_pert_data(dataset_prefix, genes=None, clusters=None, subjects=
     print("----------------------")
     
     try:
+        if os.getenv("HSV_EXPLAIN"):
+            _assert_pushdown(con, final_sql, len(where_clauses) > 1, len(final_select_list))
         df = con.execute(final_sql).df()
         print(f"Joined {len(join_clauses) + 1} files into {df.shape[0]:,} rows × {df.shape[1]} cols")
         return df, color_map
+    except AssertionError:
+        # Dev-mode pushdown guard: surface instead of returning an empty frame
+        raise
     except Exception as e:
         print(f"DuckDB Query Failed: {e}")
         return pd.DataFrame(), color_map
@@ -0,0 +1,82 @@
+# utils/run_py_gene_dot_plot.py
+
+import io
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.colors import LinearSegmentedColormap, Normalize
+from matplotlib.lines import Line2D
+from utils.r_utils import png_data_uri
+
+STATUS_LEVELS = ["Prior", "Lesion", "Post"]
+
+# Same mid-gray to red ramp as scale_fill_gradient2(mid = "gray", high = "red")
+_FILL_CMAP = LinearSegmentedColormap.from_list("dot_fill", ["#3A3A98", "gray", "red"])
+
+def _dot_area(pct):
+    """Maps 0-100 percent onto marker area, mirroring scale_size_continuous(range = c(0.1, 5))."""
+    diameter_pt = (0.1 + 4.9 * np.clip(pct, 0, 100) / 100) * 2.845
+    return diameter_pt ** 2
+
+def generate_dot_plot_py(plot_data, color_map, selected_features):
+    """
+    Matplotlib version of the R dot plot, drawn from the aggregated
+    (CellType_Level3, Status, Gene, Avg_pert, Avg_exp) table. Everything goes
+    into one axis with a single scatter call; genes are separated by vertical lines.
+    """
+    genes = [g for g in selected_features if g in set(plot_data["Gene"])]
+    celltypes = [c for c in (color_map or {}) if c in set(plot_data["CellType_Level3"])]
+    # Cell types missing from the color map still get a row, after the known ones
+    celltypes += sorted(set(plot_data["CellType_Level3"]) - set(celltypes))
+
+    gene_idx = plot_data["Gene"].map({g: i for i, g in enumerate(genes)}).to_numpy()
+    status_idx = plot_data["Status"].map({s: i for i, s in enumerate(STATUS_LEVELS)}).to_numpy()
+    ct_idx = plot_data["CellType_Level3"].map({c: i for i, c in enumerate(celltypes)}).to_numpy()
+    keep = ~(np.isnan(gene_idx.astype(float)) | np.isnan(status_idx.astype(float)))
+
+    x = (gene_idx[keep] * len(STATUS_LEVELS) + status_idx[keep]).astype(float)
+    y = ct_idx[keep].astype(float)
+    avg_exp = plot_data["Avg_exp"].to_numpy(dtype=float)[keep]
+    avg_pert = plot_data["Avg_pert"].to_numpy(dtype=float)[keep]
+
+    fig, ax = plt.subplots(figsize=(4 + len(genes) * 0.7, 3 + len(celltypes) * 0.3))
+    try:
+        vmax = np.nanmax(np.abs(avg_exp)) if np.isfinite(avg_exp).any() else 1.0
+        sc = ax.scatter(x, y, s=_dot_area(avg_pert), c=avg_exp, cmap=_FILL_CMAP,
+                        norm=Normalize(vmin=-vmax, vmax=vmax), edgecolors="black", linewidths=0.1)
+
+        n_cols = len(genes) * len(STATUS_LEVELS)
+        for i in range(1, len(genes)):
+            ax.axvline(i * len(STATUS_LEVELS) - 0.5, color="black", linewidth=0.2)
+
+        ax.set_xticks(np.arange(n_cols))
+        ax.set_xticklabels(STATUS_LEVELS * len(genes), rotation=90, fontsize=8)
+        ax.set_yticks(np.arange(len(celltypes)))
+        ax.set_yticklabels(celltypes, fontsize=8)
+        ax.set_xlim(-0.5, n_cols - 0.5)
+        ax.set_ylim(-0.5, len(celltypes) - 0.5)
+        ax.tick_params(length=0)
+
+        # Gene names sit above their Prior/Lesion/Post block
+        top = ax.secondary_xaxis("top")
+        top.set_xticks(np.arange(len(genes)) * len(STATUS_LEVELS) + 1)
+        top.set_xticklabels(genes, fontsize=8)
+        top.tick_params(length=0)
+
+        cbar = fig.colorbar(sc, ax=ax, orientation="horizontal", location="bottom", fraction=0.04, pad=0.25)
+        cbar.set_label("Average Expression", fontsize=8)
+        cbar.ax.tick_params(labelsize=8)
+
+        handles = [Line2D([], [], linestyle="", marker="o", markersize=np.sqrt(_dot_area(p)),
+                          markerfacecolor="gray", markeredgecolor="black", markeredgewidth=0.2)
+                   for p in (25, 50, 75, 100)]
+        ax.legend(handles, ["25", "50", "75", "100"], title="Percent Expressed", title_fontsize=8, fontsize=8,
+                  ncol=4, loc="upper center", bbox_to_anchor=(0.5, -0.7), frameon=False)
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=300, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+
+    return png_data_uri(buf.getvalue())
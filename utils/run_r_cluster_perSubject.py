@@ -20,11 +20,6 @@ def generate_PerSubject_StackBar_plots(dataset_prefix, subjects=None):
         tmp_color.write(json.dumps(colors_path).encode("utf-8"))
         color_file = tmp_color.name
 
-    # --- Convert selected subjects to an R vector string ---
-    subjects_r_vector = "NULL"
-    if subjects:
-        subjects_r_vector = f"c({', '.join([f'{chr(39)}{s}{chr(39)}' for s in subjects])})"
-
     # --- Calculate dynamic height based on number of subjects ---
     # Create a secure, temporary file for the R plot
     tmp_path = ""
@@ -46,7 +41,7 @@ def generate_PerSubject_StackBar_plots(dataset_prefix, subjects=None):
             # Read the pre-computed statistics and colors
             Summary_cluster_per_sample <- arrow::read_parquet("{stats_path}")
             CellType_color <- jsonlite::fromJSON("{color_file}")
-            selectedSubject <- {subjects_r_vector} # Assign the vector from Python
+            selectedSubject <- selected_subjects # Assigned from Python as a StrVector (or NULL)
 
             # Define known subject levels for consistent ordering (adjust if needed)
             subject_levels <- c("Subject1", "Subject2", "Subject3", "Subject5", "Subject6",
@@ -109,6 +104,9 @@ def generate_PerSubject_StackBar_plots(dataset_prefix, subjects=None):
             ggsave("{tmp_path}", plot = p, width = 10, height = plot_height_final, dpi = 200)
         """
 
+        # Pass the subject filter as a native R character vector; no quoting or parsing needed
+        ro.globalenv["selected_subjects"] = ro.StrVector(subjects) if subjects else ro.NULL
+
         # Execute the R code
         with localconverter(ro.default_converter + pandas2ri.converter):
             ro.r(r_code_string)
@@ -1,124 +1,200 @@
 # utils/run_r_cluster_umap.py
 
-import base64
-import os
-import json
-import tempfile
-from utils.s3_utils import (load_s3_umap, load_s3_colors)
+import functools
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from utils.s3_utils import (open_s3_umap, load_s3_colors)
+from utils.r_pool import r_task_result, submit_r_task
+from utils.r_utils import df_to_r_arrow, no_data_png, png_data_uri, r_named_colors
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
 
-def generate_umap_plot(dataset_prefix, status="All", title="", clusters=None, subjects=None):
+UMAP_COLUMNS = ["UMAP_1", "UMAP_2", "CellType_Level3", "Status", "Subject"]
+# The square UMAP panel is at most ~1000 px across at 7x5 in / 200 dpi
+UMAP_PIXEL_GRID = 1000
+UMAP_BATCH_SIZE = 200_000
+
+def _dedupe_to_pixel_grid(table, scale_limit):
     """
-    Generates a ggplot UMAP by executing a self-contained R script that
-    saves to a temp file, which Python then reads and encodes.
+    Keeps one point per (pixel, CellType_Level3, Status, Subject). Points that land
+    on the same output pixel with the same color would only overdraw each other,
+    and keeping Status/Subject in the key means every filter still sees its cells.
     """
-    # Define all necessary file paths
-    parquet_path = load_s3_umap(dataset_prefix)
-    json_path = load_s3_colors(dataset_prefix)
+    if table.num_rows == 0 or scale_limit == 0:
+        return table
 
-    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp_color:
-        tmp_color.write(json.dumps(json_path).encode("utf-8"))
-        color_file = tmp_color.name
+    step = (2 * scale_limit) / UMAP_PIXEL_GRID
+    px = np.floor((table["UMAP_1"].to_numpy() + scale_limit) / step).astype(np.int64)
+    py = np.floor((table["UMAP_2"].to_numpy() + scale_limit) / step).astype(np.int64)
+    key = px * (UMAP_PIXEL_GRID + 1) + py
 
-    clusters_r_vector = "NULL"
-    if clusters:
-        clusters_r_vector = f"c({', '.join([f'{chr(39)}{c}{chr(39)}' for c in clusters])})"
+    # Fold the categorical columns into the same int64 key via their dictionary codes
+    for col in ["CellType_Level3", "Status", "Subject"]:
+        encoded = pc.dictionary_encode(table[col]).combine_chunks()
+        codes = encoded.indices.fill_null(len(encoded.dictionary)).to_numpy().astype(np.int64)
+        key = key * (len(encoded.dictionary) + 1) + codes
 
-    subjects_r_vector = "NULL"
-    if subjects:
-        subjects_r_vector = f"c({', '.join([f'{chr(39)}{s}{chr(39)}' for s in subjects])})"
+    _, first_idx = np.unique(key, return_index=True)
+    # Preserve the original row order so draw order (and overlap) is unchanged
+    return table.take(np.sort(first_idx))
 
-    legend_r_code = ''
+def _umap_scale_limit(parquet_file):
+    """
+    Symmetric axis limit from the row-group min/max statistics, so it is known before
+    any data is decoded. Falls back to a scan of the two coordinate columns when a
+    writer did not record statistics.
+    """
+    md = parquet_file.metadata
+    coord_idx = [parquet_file.schema_arrow.get_field_index(c) for c in ("UMAP_1", "UMAP_2")]
+    bound = 0.0
+    for rg in range(md.num_row_groups):
+        for idx in coord_idx:
+            stats = md.row_group(rg).column(idx).statistics
+            if stats is None or not stats.has_min_max:
+                coords = parquet_file.read(columns=["UMAP_1", "UMAP_2"])
+                return int(np.ceil(max(
+                    np.abs(coords["UMAP_1"].to_numpy()).max(initial=0),
+                    np.abs(coords["UMAP_2"].to_numpy()).max(initial=0),
+                )))
+            bound = max(bound, abs(stats.min), abs(stats.max))
+    return int(np.ceil(bound))
+
+@functools.lru_cache(maxsize=8)
+def _load_umap_table(dataset_prefix):
+    """
+    Reads the UMAP Parquet and color map once per dataset. Later renders reuse
+    the decoded Arrow table, so a filter change never touches disk or S3.
+    The symmetric axis limit is computed here too, keeping axes stable across filters,
+    and overlapping points are collapsed to the pixel grid the plot is drawn on.
+    The file is streamed in record batches that are deduplicated as they arrive,
+    so peak memory follows the batch size rather than the full point count.
+    """
+    # Opened on S3 directly: only the footer and the plotted columns are fetched
+    with open_s3_umap(dataset_prefix) as source:
+        parquet_file = pq.ParquetFile(source)
+        colors = load_s3_colors(dataset_prefix)
+        scale_limit = _umap_scale_limit(parquet_file)
+
+        # Only the columns the plot uses are decoded from the Parquet file
+        batches = [
+            _dedupe_to_pixel_grid(pa.Table.from_batches([batch]), scale_limit)
+            for batch in parquet_file.iter_batches(batch_size=UMAP_BATCH_SIZE, columns=UMAP_COLUMNS)
+        ]
+        if batches:
+            # Points from different batches can still share a pixel; one more pass over the reduced set
+            deduped = _dedupe_to_pixel_grid(pa.concat_tables(batches), scale_limit)
+        else:
+            deduped = parquet_file.schema_arrow.empty_table().select(UMAP_COLUMNS)
+
+    print(f"UMAP {dataset_prefix}: {parquet_file.metadata.num_rows} -> {deduped.num_rows} points after pixel dedupe")
+    return deduped, colors, scale_limit
+
+def _filter_umap_table(table, status, clusters, subjects):
+    """Applies the status/cluster/subject filters with Arrow compute kernels."""
+    mask = None
     if status != "All":
-        legend_r_code = 'p <- p + theme(legend.position = "none")'
+        mask = pc.equal(table["Status"], status)
+    if clusters:
+        cond = pc.is_in(table["CellType_Level3"], value_set=pa.array(clusters))
+        mask = cond if mask is None else pc.and_(mask, cond)
+    if subjects:
+        cond = pc.is_in(table["Subject"], value_set=pa.array(subjects))
+        mask = cond if mask is None else pc.and_(mask, cond)
+    return table if mask is None else table.filter(mask)
+
+# One-time R setup: packages, theme and the render function are defined at import
+# so each request only sets arguments instead of re-parsing the whole script
+ro.r("""
+    suppressPackageStartupMessages({
+      library(ggplot2)
+      library(dplyr)
+      library(arrow)
+    })
+
+    .umap_theme <- theme(panel.border = element_rect(colour = "black", fill = NA, linewidth = 1),
+                         panel.background = element_rect(fill = NA),
+                         panel.grid = element_blank(),
+                         axis.title = element_text(size = 14),
+                         legend.title = NULL,
+                         legend.text = element_text(size = 10),
+                         legend.spacing.x = unit(0.01, 'cm'),
+                         legend.spacing.y = unit(0.01, 'cm'),
+                         legend.position = "right",
+                         legend.key.size = unit(0.5, 'cm'),
+                         legend.box.margin = margin(0, 0, 0, 0))
+
+    .render_umap <- compiler::cmpfun(function(plot_df_arrow, cell_colors, scale_limit, title, hide_legend) {
+        # Already-filtered, non-empty Arrow table handed over from Python
+        plot_df <- as.data.frame(plot_df_arrow)
+
+        # Rasterize the point cloud in C; fall back to single-pixel points
+        if (requireNamespace("scattermore", quietly = TRUE)) {
+            point_layer <- scattermore::geom_scattermore(aes(color = CellType_Level3), pointsize = 1.2, alpha = 0.8, pixels = c(1400, 1000))
+        } else {
+            point_layer <- geom_point(aes(color = CellType_Level3), shape = ".", alpha = 0.8)
+        }
+
+        p <- ggplot(plot_df, aes(x = UMAP_1, y = UMAP_2)) +
+            point_layer +
+            scale_color_manual(values = cell_colors) +
+            labs(x = "UMAP1", y = "UMAP2", title = title, color = NULL) +
+            coord_fixed(ratio = 1) +
+            xlim(-scale_limit, scale_limit) +
+            ylim(-scale_limit, scale_limit) +
+            .umap_theme +
+            guides(color = guide_legend(override.aes = list(size = 2), title.hjust = 0.5, ncol = 2, byrow = TRUE, direction = "horizontal"))
+
+        if (hide_legend) {
+            p <- p + theme(legend.position = "none")
+        }
+
+        # Return the PNG bytes straight to Python
+        .ggsave_raw(p, width = 7, height = 5, dpi = 200)
+    })
+""")
+
+def generate_umap_plot(dataset_prefix, status="All", title="", clusters=None, subjects=None):
+    """
+    Generates a ggplot UMAP by calling the pre-defined R render function,
+    which returns the PNG bytes that Python encodes as a data URI.
+    """
+    # Cached table + colors; filtering happens in Arrow before the R handoff
+    umap_table, colors, scale_limit = _load_umap_table(dataset_prefix)
+    plot_table = _filter_umap_table(umap_table, status, clusters, subjects)
+
+    # Nothing to draw: serve the cached placeholder without calling into R
+    if plot_table.num_rows == 0:
+        return no_data_png(7, 5, 200)
 
-    #  Create a secure, temporary file for the R plot
-    tmp_path = ""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp_path = tmp.name
-
-        # Construct the self-contained R script as a string
-        r_code_string = f"""
-            suppressPackageStartupMessages({{
-              library(ggplot2)
-              library(dplyr)
-              library(arrow)
-              library(jsonlite)
-            }})
-
-            # Read the data and color files
-            plot_df <- arrow::read_parquet("{parquet_path}")
-            cell_colors <- jsonlite::fromJSON("{color_file}")
-
-            # Assign the filter vectors from Python
-            selected_clusters <- {clusters_r_vector}
-            selected_subjects <- {subjects_r_vector}
-
-            # Filter data based on status
-            if ("{status}" != "All") {{
-                plot_df <- plot_df %>% filter(Status == "{status}")
-            }}
-
-            # Filter data based on selected clusters
-            if (!is.null(selected_clusters)) {{
-                plot_df <- plot_df %>% filter(CellType_Level3 %in% selected_clusters)
-            }}
-
-            # Filter data based on selected subjects
-            if (!is.null(selected_subjects)) {{
-                plot_df <- plot_df %>% filter(Subject %in% selected_subjects)
-            }}
-
-            if (nrow(plot_df) == 0) {{
-                p <- ggplot() + annotate("text", x=0, y=0, label="No data for selection") + theme_void()
-            }} else {{
-                scale_limit <- ceiling(max(abs(plot_df[, c("UMAP_1", "UMAP_2")])))
-                
-                p <- ggplot(plot_df, aes(x = UMAP_1, y = UMAP_2)) +
-                    geom_point(aes(color = CellType_Level3), size = 0.5, alpha = 0.8) +
-                    scale_color_manual(values = cell_colors) +
-                    labs(x = "UMAP1", y = "UMAP2", title = "{title}", color = NULL) +
-                    coord_fixed(ratio = 1) + 
-                    xlim(-scale_limit, scale_limit) + 
-                    ylim(-scale_limit, scale_limit) +
-                    theme(panel.border = element_rect(colour = "black", fill = NA, linewidth = 1),
-                          panel.background = element_rect(fill = NA), 
-                          panel.grid = element_blank(),
-                          axis.title = element_text(size = 14), 
-                          legend.title = NULL,
-                          legend.text = element_text(size = 10),
-                          legend.spacing.x = unit(0.01, 'cm'),
-                          legend.spacing.y = unit(0.01, 'cm'),
-                          legend.position = "right",
-                          legend.key.size = unit(0.5, 'cm'),
-                          legend.box.margin = margin(0, 0, 0, 0))+
-                   guides(color = guide_legend(override.aes = list(size = 2), title.hjust = 0.5, ncol = 2, byrow = TRUE, direction = "horizontal"))
-            }}
-            
-            {legend_r_code}
-
-            # Save the plot to the temporary file path provided by Python
-            ggsave("{tmp_path}", plot = p, width = 7, height = 5, dpi = 200)
-        """
-
-        # Execute the R code
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            ro.r(r_code_string)
-
-        # Read the generated image file and encode it
-        with open(tmp_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
-        
-        return f"data:image/png;base64,{encoded_image}"
+        # Only the arguments cross into R; the script itself was parsed at import
+        png_raw = ro.globalenv[".render_umap"](
+            df_to_r_arrow(plot_table),
+            r_named_colors(colors),
+            scale_limit,
+            title,
+            status != "All",
+        )
+        return png_data_uri(png_raw)
 
     except Exception:
         import traceback
         print(f"--- ERROR generating UMAP for Status: {status} ---")
         print(traceback.format_exc())
         return ""
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
\ No newline at end of file
+
+def generate_umap_plots(dataset_prefix, panels, clusters=None, subjects=None):
+    """
+    Renders several UMAP panels concurrently, one per (status, title) pair in `panels`,
+    on the shared R worker pool. Each worker keeps its own cached table, so repeat
+    requests are pure rendering. Returns the data URIs in the order of `panels`.
+    """
+    futures = [
+        submit_r_task(generate_umap_plot, dataset_prefix, status, title, clusters, subjects)
+        for status, title in panels
+    ]
+    return [
+        r_task_result(f, generate_umap_plot, dataset_prefix, status, title, clusters, subjects)
+        for f, (status, title) in zip(futures, panels)
+    ]
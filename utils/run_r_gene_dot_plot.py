@@ -1,197 +1,207 @@
 # utils/run_r_dot_plot.py
 
-import base64
 import os
-import tempfile
+import duckdb
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
-from utils.db_connection import dict_to_r_vector
+from utils.r_pool import df_to_ipc, ipc_to_df, narrow_columns, submit_r_task
+from utils.r_utils import df_to_r_arrow, no_data_png, png_data_uri, r_named_colors
+from utils.run_py_gene_dot_plot import generate_dot_plot_py
+
+# Set USE_PYTHON_DOTPLOT=1 to draw the dot plot with matplotlib instead of ggplot2
+USE_PYTHON_DOTPLOT = os.getenv("USE_PYTHON_DOTPLOT", "").lower() in ("1", "true", "yes")
+
+# One-time R setup: packages are attached and the dot plot function is defined
+# at import, so each request only passes its data and arguments
+ro.r("""
+    suppressPackageStartupMessages({
+        library(ggplot2)
+        library(jsonlite)
+        library(ggh4x)
+        library(arrow)
+    })
+
+    .render_dotplot <- compiler::cmpfun(function(plot_data_py, CellType_color, selectedFeature, n_genes, n_cell_types) {
+        # Suppressing warnings speeds up execution by preventing console I/O lag
+        suppressWarnings(suppressMessages({
+    
+            # Start timing
+            start_time <- Sys.time()
+            cat("--- R Dot Plot: Script execution started ---\\n", file=stderr())
+
+            # --- Pre-aggregated Arrow table from Python ---
+            plot.data = as.data.frame(plot_data_py)
+
+            if (length(selectedFeature) == 0) {
+                stop("No selected features provided from Python.")
+            }
+
+            suppressWarnings({
+                plot.data$Gene = factor(plot.data$Gene, levels = selectedFeature)
+                plot.data$Status = factor(plot.data$Status, levels = c("Prior", "Lesion", "Post"))
+                plot.data$CellType_Level3 = factor(plot.data$CellType_Level3, levels = names(CellType_color))
+            
+                # Plot size follows the data actually drawn (counts come from Python)
+                calc_w = 4 + n_genes * 0.7
+                calc_h = 3 + n_cell_types * 0.3
+
+                # plotting
+                if (nrow(plot.data) == 0) {
+                    stop("No data available for the selected features and cell types.")
+                } else {
+                    # One panel: Status nested under Gene on the x axis instead of a celltype x gene facet grid
+                    g = ggplot(plot.data, aes(x = interaction(Status, Gene, sep = "&"), y = CellType_Level3)) + 
+                        geom_point(aes(fill = Avg_exp, size = Avg_pert), colour = "black", pch = 21, stroke = 0.1) +
+                        scale_fill_gradient2(mid = "gray", high = "red") +
+                        scale_x_discrete(guide = guide_axis_nested(delim = "&")) +
+                        theme_minimal(base_size = 8) + 
+                        theme(panel.border = element_rect(colour = "black", fill = NA, linewidth = 0.2),
+                                panel.grid.major = element_blank(),
+                                panel.grid.minor = element_blank(),
+                                panel.background = element_blank(),
+                                axis.ticks.length = unit(0, "pt"),
+                                axis.text.x = element_text(size = 8, angle = 90, hjust = 1, vjust = 0.5, colour = "black", margin = margin(t = 2, r = 0, b = 0, l = 0)),
+                                axis.text.y = element_text(size = 8, colour = "black", margin = margin(t = 0, r = 2, b = 0, l = 0)),
+                                ggh4x.axis.nesttext.x = element_text(size = 8, colour = "black", angle = 0, hjust = 0.5),
+                                axis.title.x = element_blank(),
+                                axis.title.y = element_blank(),
+                                plot.margin = margin(0,0,0,0),
+                                legend.box = "vertical",
+                                legend.position = "bottom",
+                                legend.box.just = "center",
+                                legend.margin = margin(0, 0, 0, 0),
+                                legend.box.margin = margin(0, 0, 0, 0),
+                                legend.title = element_text(size = 8),
+                                legend.text = element_text(size = 8),
+                                legend.key.height = unit(1.5, "lines"),
+                                legend.key.width = unit(1.5, "lines"))  +
+                        scale_size_continuous(range = c(0.1, 5), limits = c(0, 100)) + 
+                        labs(size = "Percent Expressed", fill = "Average Expression") +
+                        guides(
+                                size = guide_legend(
+                                    title.position = "top",
+                                    title.hjust = 0.5,
+                                    nrow = 1, 
+                                    override.aes = list(shape = 21, colour = "black", fill = "gray", stroke = 0.2),
+                                    keyheight = unit(1, "lines"),
+                                    keywidth  = unit(1.5, "lines")
+                                ),
+                                fill = guide_colorbar(
+                                    title.position = "top",
+                                    title.hjust = 0.5
+                                )
+                            )
+                }
+
+                # --- Save plot ---
+                png_raw <- .ggsave_raw(g, width = calc_w, height = calc_h, dpi = 300, limitsize = FALSE)
+
+                # End timing
+                end_time <- Sys.time()
+                cat("DotPlot Computation time: ", round(end_time - start_time, 3), " sec\\n")
+            })
+        }))
+
+        png_raw
+    })
+""")
+
+def _aggregate_dot_plot_data(data_pert, data_gex, selected_features, selected_celltypes):
+    """
+    Collapses the per-cell Pert and GEX tables to one row per (CellType_Level3, Status, Gene)
+    with Avg_pert and Avg_exp, which is all the dot plot draws. Both frames are scanned
+    once by DuckDB; the wide gene block is averaged per group and only that small
+    result is UNPIVOTed, so no cell x gene long table is ever built.
+    """
+    # An empty selection or "All" keeps every cell type
+    celltype_filter = ""
+    params = []
+    if selected_celltypes and "All" not in selected_celltypes:
+        celltype_filter = "WHERE list_contains(?, CellType_Level3::VARCHAR)"
+        params = [list(selected_celltypes), list(selected_celltypes)]
+
+    gene_cols = ", ".join(f'"{g}"' for g in selected_features)
+    pert_avgs = ", ".join(f'AVG(COALESCE("{g}", 0)) AS "{g}"' for g in selected_features)
+    gex_avgs = ", ".join(f'AVG("{g}") AS "{g}"' for g in selected_features)
+
+    query = f"""
+        WITH pert_wide AS (
+            -- Calculate Cytokine+ Pert within CellType and Status
+            SELECT CellType_Level3::VARCHAR AS CellType_Level3, Status::VARCHAR AS Status, {pert_avgs}
+            FROM data_pert {celltype_filter}
+            GROUP BY 1, 2
+        ),
+        sample_wide AS (
+            -- Gene intensity: average per sample (Subject x Status) first...
+            SELECT Subject, CellType_Level3::VARCHAR AS CellType_Level3, Status::VARCHAR AS Status, {gex_avgs}
+            FROM data_gex {celltype_filter}
+            GROUP BY 1, 2, 3
+        ),
+        exp_wide AS (
+            -- ...then across samples
+            SELECT CellType_Level3, Status, {gex_avgs}
+            FROM sample_wide
+            GROUP BY 1, 2
+        ),
+        pert AS (UNPIVOT pert_wide ON {gene_cols} INTO NAME Gene VALUE Avg_pert),
+        exp AS (UNPIVOT exp_wide ON {gene_cols} INTO NAME Gene VALUE Avg_exp)
+        SELECT pert.CellType_Level3, pert.Status, pert.Gene, pert.Avg_pert, exp.Avg_exp
+        FROM pert
+        LEFT JOIN exp USING (CellType_Level3, Status, Gene)
+    """
+
+    # Private in-memory connection: registered frames must not leak across concurrent callbacks
+    con = duckdb.connect()
+    try:
+        con.register("data_pert", data_pert)
+        con.register("data_gex", data_gex)
+        return con.execute(query, params).df()
+    finally:
+        con.close()
 
 def generate_dot_plot_from_df(data_pert, data_gex, color_file, selected_features, selected_celltypes):
     """
-    Generate a dot plot using the R computeDotPlot() function from a pandas DataFrame.
+    Generate a dot plot using the pre-defined R .render_dotplot() function from a pandas DataFrame.
     """
-    tmp_path = ""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp_path = tmp.name
-        tmp_path_r = tmp_path.replace("\\", "/")
-
-        r_color_string = dict_to_r_vector(color_file)
-
-        # Pass the dataframe to R
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            ro.globalenv["data_pert_py"] = data_pert
-            ro.globalenv["data_gex_py"] = data_gex
-            # ro.globalenv["color_file"] = color_file
-            ro.globalenv['selected_features_r'] = ro.StrVector(selected_features)
-            ro.globalenv['selected_celltypes_r'] = ro.StrVector(selected_celltypes)
-        
-        # color_file_r = color_file.replace("\\", "/")
-
-        r_code = f"""
-            suppressPackageStartupMessages({{
-                library(ggplot2)
-                library(dplyr)
-                library(reshape2)
-                library(jsonlite)
-                library(tidyr)
-                library(ggh4x)
-            }})
-
-            # Suppressing warnings speeds up execution by preventing console I/O lag
-            suppressWarnings(suppressMessages({{
-            
-                # Start timing
-                start_time <- Sys.time()
-                cat("--- R Dot Plot: Script execution started ---\\n", file=stderr())
-
-                CellType_color <- {r_color_string}
-                if (is.list(CellType_color)) {{
-                    CellType_color <- unlist(CellType_color)
-                }}
-    
-                # --- Assign Python variables in R ---
-                data_pert = data_pert_py
-                data_gex = data_gex_py
-                selectedFeature = selected_features_r
-                selectedCellType = selected_celltypes_r
-
-                if (length(selectedCellType) == 0) {{
-                    cat("selectedCellType empty — defaulting to 'All'\n", file = stderr())
-                    selectedCellType <- "All"
-                }}
-                if (length(selectedFeature) == 0) {{
-                    stop("No selected features provided from Python.")
-                }}
-
-                suppressWarnings({{
-                    # Calculate Cytokine+ Pert within CellType and Status
-                    GenePert = data_pert
-                    GenePert[is.na(GenePert)] = 0
-                    
-                    # Extracte Cytokine/Gene expression data
-                    Pert_Gene = GenePert %>%
-                        dplyr::select(Subject, CellType_Level3, Status, all_of(selectedFeature)) %>% 
-                        group_by(CellType_Level3, Status) %>%
-                        dplyr::filter(if (any(selectedCellType == "All")) TRUE
-                                        else CellType_Level3 %in% selectedCellType) %>%
-                        droplevels() %>%
-                        pivot_longer(cols = all_of(selectedFeature), names_to = "Gene", values_to = "percent") %>%
-                        dplyr::mutate(Gene = factor(Gene, levels = selectedFeature))
-                    
-                    # Calculate Gene Intensity
-                    Exp_Gene = data_gex %>%
-                        dplyr::select(Subject, CellType_Level3, Status, all_of(selectedFeature)) %>%
-                        mutate(orig.ident = paste(Subject, Status, sep = "_")) %>%
-                        group_by(orig.ident, CellType_Level3) %>%
-                        summarise(across(-c(Subject, Status), function(x) mean(x, na.rm = TRUE))) %>%
-                        separate(orig.ident, into = c("Subject", "Status"), sep = "_") %>%
-                        dplyr::filter(if (any(selectedCellType == "All")) TRUE
-                                        else CellType_Level3 %in% selectedCellType) %>%
-                        droplevels() %>% 
-                        pivot_longer(cols = all_of(selectedFeature), names_to = "Gene", values_to = "expression") %>%
-                        dplyr::mutate(Gene = factor(Gene, levels = selectedFeature))
-                        
-                    # Prepare data for plotting
-                    data.plot1 = Pert_Gene %>% 
-                        group_by(CellType_Level3, Status, Gene) %>%
-                        summarise(Avg_pert = mean(percent), .groups = 'drop') %>%
-                        dplyr::mutate(idx = paste(CellType_Level3, Status, Gene, sep = "_"))
-
-                    data.plot2 = Exp_Gene %>%
-                        group_by(CellType_Level3, Status, Gene) %>%
-                        summarise(Avg_exp = mean(expression), .groups = 'drop') %>%
-                        dplyr::mutate(idx = paste(CellType_Level3, Status, Gene, sep = "_"))
-
-                    plot.data = data.plot1 %>% left_join(data.plot2[,c("idx", "Avg_exp")], by = "idx") %>%
-                        dplyr::mutate(Gene = factor(Gene, levels = selectedFeature),
-                                    Status = factor(Status, levels = c("Prior", "Lesion", "Post")),
-                                    CellType_Level3 = factor(CellType_Level3, levels = names(CellType_color)))
-                    
-                    # plotting
-                    if (nrow(plot.data) == 0) {{
-                        stop("No data available for the selected features and cell types.")
-                    }} else {{
-                        g = ggplot(plot.data, aes(x = Status, y = CellType_Level3)) + 
-                            geom_point(aes(fill = Avg_exp, size = Avg_pert), colour = "black", pch = 21, stroke = 0.1) +
-                            scale_fill_gradient2(mid = "gray", high = "red") +
-                            facet_grid2(CellType_Level3 ~ Gene, scales = "free_y") +
-                            theme_minimal(base_size = 8) + 
-                            theme(panel.border = element_rect(colour = "black", fill = NA, linewidth = 0.2),
-                                    panel.grid.major = element_blank(),
-                                    panel.grid.minor = element_blank(),
-                                    panel.background = element_blank(),
-                                    strip.text = element_text(size = 8),
-                                    strip.text.x = element_text(size = 8, colour = "black", angle = 0, margin = margin(t = 0, r = 0, b = 2, l = 0)),
-                                    strip.text.y = element_text(size = 0, colour = "black", angle = 0, margin = margin(t = 0, r = 0, b = 0, l = 0)),
-                                    axis.ticks.length = unit(0, "pt"),
-                                    axis.text.x = element_text(size = 8, angle = 90, hjust = 1, vjust = 0.5, colour = "black", margin = margin(t = 2, r = 0, b = 0, l = 0)),
-                                    axis.text.y = element_text(size = 8, colour = "black", margin = margin(t = 0, r = 2, b = 0, l = 0)),
-                                    axis.title.x = element_blank(),
-                                    axis.title.y = element_blank(),
-                                    plot.margin = margin(0,0,0,0),
-                                    legend.box = "vertical",
-                                    legend.position = "bottom",
-                                    legend.box.just = "center",
-                                    legend.margin = margin(0, 0, 0, 0),
-                                    legend.box.margin = margin(0, 0, 0, 0),
-                                    legend.title = element_text(size = 8),
-                                    legend.text = element_text(size = 8),
-                                    legend.key.height = unit(1.5, "lines"),
-                                    legend.key.width = unit(1.5, "lines"),
-                                    panel.spacing = unit(0.02, "lines"))  +
-                            scale_size_continuous(range = c(0.1, 5), limits = c(0, 100)) + 
-                            labs(size = "Percent Expressed", fill = "Average Expression") +
-                            guides(
-                                    size = guide_legend(
-                                        title.position = "top",
-                                        title.hjust = 0.5,
-                                        nrow = 1, 
-                                        override.aes = list(shape = 21, colour = "black", fill = "gray", stroke = 0.2),
-                                        keyheight = unit(1, "lines"),
-                                        keywidth  = unit(1.5, "lines")
-                                    ),
-                                    fill = guide_colorbar(
-                                        title.position = "top",
-                                        title.hjust = 0.5
-                                    )
-                                )
-                    }}
-
-                    # --- Save plot ---
-                    n_genes = length(unique(exp_meta_df_reshape$Gene))
-                    n_cell_types = length(unique(exp_meta_df_reshape$CellType_Level3))
-
-                    base_w = 4
-                    base_h = 3
-                    
-                    # Add incremental width/height
-                    calc_w = base_w + (n_genes * 0.7)
-                    calc_h = base_h + (n_cell_types * 0.3)
-
-                    ggsave("{tmp_path_r}", plot = g, device = "png", width = calc_w, height = calc_h, dpi = 300, limitsize = FALSE)
-
-                    # End timing
-                    end_time <- Sys.time()
-                    cat("DotPlot Computation time: ", round(end_time - save_start, 3), " sec\n")
-                }})
-            }}))
-        """
-        ro.r(r_code)
-
-        # Encode and return
-        with open(tmp_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
-        return f"data:image/png;base64,{encoded_image}", []
+        # Genes missing from either table cannot be drawn; with none left, skip R entirely
+        selected_features = [g for g in selected_features if g in data_pert.columns and g in data_gex.columns]
+        if not selected_features:
+            return no_data_png(7, 5, 200), ["None of the selected genes are available."]
+
+        # Aggregate in DuckDB so only the small per-group table crosses into R
+        plot_data = _aggregate_dot_plot_data(data_pert, data_gex, selected_features, selected_celltypes)
+        if plot_data.empty:
+            return no_data_png(7, 5, 200), ["No data available for the selected features and cell types."]
+
+        if USE_PYTHON_DOTPLOT:
+            return generate_dot_plot_py(plot_data, color_file, selected_features), []
+
+        r_color_vector = r_named_colors(color_file)
+
+        png_raw = ro.globalenv[".render_dotplot"](
+            df_to_r_arrow(plot_data),
+            r_color_vector,
+            ro.StrVector(selected_features),
+            plot_data["Gene"].nunique(),
+            plot_data["CellType_Level3"].nunique(),
+        )
+        return png_data_uri(png_raw), []
 
     except Exception as e:
         print(f"--- ERROR generating Dot Plot from df ---\\n{e}")
         return "/assets/error_placeholder.png", [str(e)]
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
\ No newline at end of file
+
+def _dot_plot_task(pert_ipc, gex_ipc, color_file, selected_features, selected_celltypes):
+    """Worker-side entry: rebuilds the frames from Arrow IPC and renders in the worker's R."""
+    return generate_dot_plot_from_df(ipc_to_df(pert_ipc), ipc_to_df(gex_ipc), color_file, selected_features, selected_celltypes)
+
+def submit_dot_plot(data_pert, data_gex, color_file, selected_features, selected_celltypes):
+    """
+    Queues the dot plot on the R worker pool and returns a Future of (src, messages).
+    Frames travel as Arrow IPC bytes rather than pickled DataFrames, with the gene
+    columns narrowed (uint8 percents where lossless, float32 otherwise).
+    """
+    data_pert = narrow_columns(data_pert, selected_features)
+    data_gex = narrow_columns(data_gex, selected_features)
+    return submit_r_task(_dot_plot_task, df_to_ipc(data_pert), df_to_ipc(data_gex), color_file,
+                         list(selected_features), list(selected_celltypes or []))
@@ -1,146 +1,155 @@
 # utils/run_r_heatmap.py
 
-import base64
-import os
-import tempfile
+import numpy as np
+import pandas as pd
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
+from rpy2.robjects import numpy2ri
 from rpy2.robjects.conversion import localconverter
-from utils.db_connection import dict_to_r_vector
+from utils.r_pool import df_to_ipc, ipc_to_df, narrow_columns, submit_r_task
+from utils.r_utils import df_to_r_arrow, no_data_png, png_data_uri, r_named_colors
+
+# One-time R setup: ComplexHeatmap alone takes over a second to attach, so packages
+# are loaded and the heatmap function is compiled once at import
+ro.r("""
+    suppressPackageStartupMessages({
+        library(arrow)
+        library(circlize)
+        library(ComplexHeatmap)
+        library(ragg)
+    })
+    ht_opt$message = FALSE
+
+    .render_heatmap <- compiler::cmpfun(function(plot_data_filtered_py, ht_data, column_order, CellType_color, selectedFeature) {
+        # Suppressing warnings speeds up execution by preventing console I/O lag
+        suppressWarnings({
+            # Start timing
+            start_time <- Sys.time()
+            cat("--- R Heatmap: Script execution started ---\\n", file=stderr())
+
+            plot_data_filtered <- as.data.frame(plot_data_filtered_py)
+
+            if (length(selectedFeature) == 0) {
+                stop("No selected features provided from Python.")
+            }
+
+            # --- Generate Heatmap ---
+            # ht_data arrives from Python as a genes x cells matrix already in selectedFeature order
+            rownames(ht_data) = selectedFeature
+
+            # Prepare annotation for heatmap
+            ht_meta = plot_data_filtered[, c("CellType_Level3", "Status", "Subject"), drop = FALSE]
+            ht_meta$CellType_Level3 = factor(ht_meta$CellType_Level3, levels = names(CellType_color))
+            ht_meta$Status = factor(ht_meta$Status, levels = c("Prior", "Lesion", "Post"))
+
+            # column_order (celltype --> status --> subject) is precomputed in Python
+            
+            # Create column annotation for CellType
+            anno_celltype_status = HeatmapAnnotation(CellType = ht_meta$CellType_Level3,
+                                                    Status = ht_meta$Status,
+                                                    annotation_name_gp = gpar(fontsize = 12), 
+                                                    border = TRUE,
+                                                    simple_anno_size = unit(0.4, "cm"), 
+                                                    annotation_legend_param = list(title_gp = gpar(fontsize = 12), 
+                                                                                    labels_gp = gpar(fontsize = 12),
+                                                                                    nrow = 3, by_row = FALSE, direction = "horizontal"),
+                                                    col = list(CellType = CellType_color,
+                                                                Status = c("Prior" = "#0F9D58",  "Lesion" = "#DB4437", "Post" = "#F4B400")))
+            
+            # Create a color mapping for the heatmap
+            col_fun = colorRamp2(c(0, 0.01, 7), c("gray","blue", "red"))
+            
+            # Generate the heatmap with column annotations
+            htmp = Heatmap(ht_data, col = col_fun, row_names_side = "right", 
+                        cluster_rows = FALSE, cluster_columns = FALSE, 
+                        show_column_names = FALSE, column_order = column_order, 
+                        top_annotation = anno_celltype_status,
+                        column_title_gp = gpar(fontsize = 0), 
+                        column_split = ht_meta$CellType_Level3, 
+                        column_title_rot = 45, 
+                        row_names_gp = gpar(fontsize = 12),
+                        row_title = NULL,
+                        border = TRUE, 
+                        heatmap_legend_param = list(title = "Expression\\nLevel", title_position = "topcenter", direction = "horizontal", 
+                                                        title_gp = gpar(col = "red", fontsize = 12), 
+                                                        labels_gp = gpar(col = "black", fontsize = 12)),
+                        # Cell matrix is drawn as one bitmap rather than a rect grob per cell
+                        use_raster = TRUE, raster_device = "agg_png", raster_quality = 2)
+
+            # --- Save plot safely ---
+            save_start <- Sys.time()
+            cat("  Step 4: Saving ggplot heatmap...\\n", file=stderr())
+
+            # Very wide matrices are already rasterized; a lower resolution keeps the PNG small
+            out_res = if (ncol(ht_data) > 5000) 100 else 150
+            agg_png(.png_scratch, width = 12, height = max(3, 0.4*dim(ht_data)[1]), units = "in", res = out_res)
+            draw(htmp, merge_legend = TRUE, heatmap_legend_side = "bottom", annotation_legend_side = "bottom")
+            dev.off()
+            png_raw <- .read_png_scratch()
+
+            # End timing
+            end_time <- Sys.time()
+            cat("Heatmap Computation time: ", round(end_time - save_start, 3), " sec\\n")
+        })
+
+        png_raw
+    })
+""")
+
+def _heatmap_column_order(df, color_map):
+    """
+    1-based column order sorting cells by celltype (color map order), then status, then subject,
+    computed with numpy.lexsort on integer category codes.
+    """
+    ct_codes = pd.Categorical(df["CellType_Level3"], categories=list(color_map or {})).codes
+    st_codes = pd.Categorical(df["Status"], categories=["Prior", "Lesion", "Post"]).codes
+    subj_codes = pd.factorize(df["Subject"], sort=True)[0]
+    # lexsort uses the last key as the primary one
+    return np.lexsort((subj_codes, st_codes, ct_codes)) + 1
 
 def generate_heatmap_from_df(df, color_file, selected_features):
     """
-    Generate a heatmap using the R computeHeatmap() function from a pre-loaded DataFrame.
+    Generate a heatmap using the pre-defined R .render_heatmap() function from a pre-loaded DataFrame.
     """
-    tmp_path = ""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp_path = tmp.name
-        tmp_path_r = tmp_path.replace("\\", "/")
-
-        r_color_string = dict_to_r_vector(color_file)
-
-        # Pass the dataframe to R
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            ro.globalenv["plot_data_filtered"] = df
-            # ro.globalenv["color_file"] = color_file
-            ro.globalenv['selected_features_r'] = ro.StrVector(selected_features)
-        
-        # color_file_r = color_file.replace("\\", "/")
-
-        r_code = f"""
-            suppressPackageStartupMessages({{
-                library(ggplot2)
-                library(dplyr)
-                library(arrow)
-                library(duckdb)
-                library(glue)
-                library(jsonlite)
-                library(RColorBrewer)
-                library(circlize)
-                library(ComplexHeatmap)
-                library(ragg)
-            }})
-
-            # Suppressing warnings speeds up execution by preventing console I/O lag
-            suppressWarnings({{
-                # Start timing
-                start_time <- Sys.time()
-                cat("--- R Heatmap: Script execution started ---\\n", file=stderr())
-                
-                CellType_color <- {r_color_string}
-
-                if (is.list(CellType_color)) {{
-                    CellType_color <- unlist(CellType_color)
-                }}
-
-                # Bail out early if nothing to plot
-                if (nrow(plot_data_filtered) == 0) {{
-                    p_out <- ggplot() + annotate("text", x=0.5, y=0.5, label="No data for filter selection") + theme_void()
-                    ggsave("{tmp_path_r}", plot = p_out, width = 6, height = 4, dpi = 150)
-                    stop("No data remaining after filtering.", call. = FALSE)
-                }}
-
-                selectedFeature = selected_features_r
-                if (length(selectedFeature) == 0) {{
-                    stop("No selected features provided from Python.")
-                }}
-
-                # --- Generate Heatmap ---
-                # Prepare matrix for heatmap
-                ht_data = as.matrix(t(plot_data_filtered[, !(names(plot_data_filtered) %in% c("orig.ident", "Barcode", "UMAP_1", "UMAP_2", "Subject", "CellType_Level3", "Status"))]))
-
-                # Prepare annotation for heatmap
-                ht_meta = plot_data_filtered[, c("CellType_Level3", "Status", "Subject"), drop = FALSE]
-                ht_meta$CellType_Level3 = factor(ht_meta$CellType_Level3, levels = names(CellType_color))
-                ht_meta$Status = factor(ht_meta$Status, levels = c("Prior", "Lesion", "Post"))
-
-                # re-order columns by celltype --> status
-                column_order = order(plot_data_filtered$CellType_Level3, plot_data_filtered$Status, plot_data_filtered$Subject)
-                
-                # re-order rows by selected features
-                row_order = match(selectedFeature, rownames(ht_data))
-                ht_data = ht_data[row_order, ]
-                
-                # Create column annotation for CellType
-                anno_celltype_status = HeatmapAnnotation(CellType = ht_meta$CellType_Level3,
-                                                        Status = ht_meta$Status,
-                                                        annotation_name_gp = gpar(fontsize = 12), 
-                                                        border = TRUE,
-                                                        simple_anno_size = unit(0.4, "cm"), 
-                                                        annotation_legend_param = list(title_gp = gpar(fontsize = 12), 
-                                                                                        labels_gp = gpar(fontsize = 12),
-                                                                                        nrow = 3, by_row = FALSE, direction = "horizontal"),
-                                                        col = list(CellType = CellType_color,
-                                                                    Status = c("Prior" = "#0F9D58",  "Lesion" = "#DB4437", "Post" = "#F4B400")))
-                
-                # Create a color mapping for the heatmap
-                col_fun = colorRamp2(c(0, 0.01, 7), c("gray","blue", "red"))
-                ht_opt$message = FALSE
-                
-                # Generate the heatmap with column annotations
-                htmp = Heatmap(ht_data, col = col_fun, row_names_side = "right", 
-                            cluster_rows = FALSE, cluster_columns = FALSE, 
-                            show_column_names = FALSE, column_order = column_order, 
-                            top_annotation = anno_celltype_status,
-                            row_split = seq(1, nrow(ht_data)),
-                            column_title_gp = gpar(fontsize = 0), 
-                            column_split = ht_meta$CellType_Level3, 
-                            column_title_rot = 45, 
-                            row_names_gp = gpar(fontsize = 12),
-                            row_title = NULL,
-                            row_gap = unit(1, "mm"),
-                            border = TRUE, 
-                            heatmap_legend_param = list(title = "Expression\nLevel", title_position = "topcenter", direction = "horizontal", 
-                                                            title_gp = gpar(col = "red", fontsize = 12), 
-                                                            labels_gp = gpar(col = "black", fontsize = 12)), use_raster = FALSE)
-
-                # --- Save plot safely ---
-                save_start <- Sys.time()
-                cat("  Step 4: Saving ggplot heatmap...\n", file=stderr())
-
-                agg_png("{tmp_path_r}", width = 12, height = max(3, 0.4*dim(ht_data)[1]), units = "in", res = 150)
-                draw(htmp, merge_legend = TRUE, heatmap_legend_side = "bottom", annotation_legend_side = "bottom")
-                dev.off()
-
-                # End timing
-                end_time <- Sys.time()
-                cat("Heatmap Computation time: ", round(end_time - save_start, 3), " sec\n")
-            }})
-        """
-        ro.r(r_code)
-
-        # Encode and return
-        with open(tmp_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
-        return f"data:image/png;base64,{encoded_image}", []
+        # Nothing to plot: cached placeholder, no R call
+        if df.empty:
+            return no_data_png(6, 4, 150), ["No data remaining after filtering."]
+
+        r_color_vector = r_named_colors(color_file)
+
+        # Genes x cells matrix built in numpy: the transpose of a C-ordered cell x gene
+        # block is already R's column-major layout, so numpy2ri copies its buffer into an
+        # R matrix in one pass (no per-cell Python floats) and sets dim itself
+        genes = [g for g in selected_features if g in df.columns]
+        ht_data = np.ascontiguousarray(df[genes].to_numpy(dtype=np.float64)).T
+        column_order = _heatmap_column_order(df, color_file)
+        with localconverter(ro.default_converter + numpy2ri.converter) as cv:
+            r_ht_data = cv.py2rpy(ht_data)
+
+        # Only the annotation columns travel as a table (zero-copy Arrow handoff)
+        png_raw = ro.globalenv[".render_heatmap"](
+            df_to_r_arrow(df[["Subject", "CellType_Level3", "Status"]]),
+            r_ht_data,
+            ro.IntVector(column_order),
+            r_color_vector,
+            ro.StrVector(genes),
+        )
+        return png_data_uri(png_raw), []
 
     except Exception as e:
         print(f"--- ERROR generating Heatmap Plot from df ---\\n{e}")
         return "/assets/error_placeholder.png", [str(e)]
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+
+def _heatmap_task(df_ipc, color_file, selected_features):
+    """Worker-side entry: rebuilds the frame from Arrow IPC and renders in the worker's R."""
+    return generate_heatmap_from_df(ipc_to_df(df_ipc), color_file, selected_features)
+
+def submit_heatmap(df, color_file, selected_features):
+    """
+    Queues the heatmap on the R worker pool and returns a Future of (src, messages).
+    Only the annotation columns and selected genes are serialized, as Arrow IPC,
+    with the gene columns narrowed to float32.
+    """
+    keep = ["Subject", "CellType_Level3", "Status", *selected_features]
+    df = narrow_columns(df.loc[:, [c for c in keep if c in df.columns]], selected_features)
+    return submit_r_task(_heatmap_task, df_to_ipc(df), color_file, list(selected_features))
@@ -1,62 +1,59 @@
 # utils/run_r_gene_umap.py
 
-import base64
-import os
-import tempfile
+import pandas as pd
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
-
-def generate_feature_umap_from_df(df, selected_features):
-    """
-    Generate UMAP plots (colored by gene expression or clusters)
-    directly from a pre-loaded pandas DataFrame.
-    """
-    tmp_path = ""
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp_path = tmp.name
-        tmp_path_r = tmp_path.replace("\\", "/")
-
-        # Pass the dataframe to R
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            ro.globalenv["plot_data_filtered"] = df
-            ro.globalenv['selected_features_r'] = ro.StrVector(selected_features)
-
-        r_code = f"""
-            suppressPackageStartupMessages({{
-                library(ggplot2)
-                library(dplyr)
-                library(patchwork)
-                library(scales)
-                library(grid)
-            }})
-
-            # Suppressing warnings speeds up execution by preventing console I/O lag
-            suppressWarnings(suppressMessages({{
-            
-                # Start timing
-                save_start <- Sys.time()
-                cat("--- R Feature UMAP Plot: Script execution started ---\\n", file=stderr())
-
-                # --- Determine genes available for plotting ---
-                gene_cols <- setdiff(colnames(plot_data_filtered),
-                                    c("Barcode", "UMAP_1", "UMAP_2", "CellType_Level3", "Subject", "Status"))
-                cat(paste0("   Genes available for plotting: ", paste(gene_cols, collapse=", "), "\\n"), file=stderr())
-
-                selectedFeature = selected_features_r
-                if (length(selectedFeature) > 0) {{
-                    gene_cols <- intersect(selectedFeature, gene_cols)
-                }}
-
-                # reorder genes to match selectedFeature order
-                gene_cols <- gene_cols[match(gene_cols, selectedFeature)]
-
-                if (length(gene_cols) > 0) {{
-                    # base UMAP
+from utils.helper import frame_fingerprint
+from utils.png_cache import png_cache_get, png_cache_key, png_cache_put
+from utils.r_pool import df_to_ipc, ipc_to_df, narrow_columns, submit_r_task
+from utils.r_utils import df_to_r_arrow, png_data_uri
+
+UMAP_BASE_CACHE_SIZE = 8 # Base (density contour) plots kept in the R session
+UMAP_DENSITY_SAMPLE = 20000 # Cells used to estimate the density contours
+UMAP_DENSITY_MIN_CELLS = 2000 # Below this, a point silhouette replaces the contours
+
+# One-time R setup: packages are attached and the render function is compiled at import,
+# so each call only passes its inputs instead of re-parsing the script
+ro.r("""
+    suppressPackageStartupMessages({
+        library(ggplot2)
+        library(dplyr)
+        library(patchwork)
+        library(scales)
+        library(grid)
+        library(arrow)
+        library(ragg)
+    })
+
+    # Base (density contour) plots keyed by a fingerprint of the cell coordinates
+    .feature_umap_base <- new.env()
+
+    .render_feature_umap <- compiler::cmpfun(function(plot_data_arrow, pos_df_arrow, gene_cols, umap_base_key,
+                                                      density_sample, density_min_cells, base_cache_size) {
+        # Suppressing warnings speeds up execution by preventing console I/O lag
+        suppressWarnings(suppressMessages({
+            # Start timing
+            save_start <- Sys.time()
+            cat("--- R Feature UMAP Plot: Script execution started ---\\n", file=stderr())
+            plot_data_filtered <- as.data.frame(plot_data_arrow)
+
+            cat(paste0("   Genes available for plotting: ", paste(gene_cols, collapse=", "), "\\n"), file=stderr())
+
+            if (length(gene_cols) > 0) {
+                # base UMAP, cached per set of cell coordinates
+                base_umap_plot <- .feature_umap_base[[umap_base_key]]
+                if (is.null(base_umap_plot)) {
                     scale_limit <- ceiling(max(abs(plot_data_filtered[, c("UMAP_1", "UMAP_2")]), na.rm=TRUE))
-                    base_umap_plot <- ggplot(data = plot_data_filtered, aes(x = UMAP_1, y = UMAP_2)) +
-                        geom_density_2d(aes(color = ..level..), size = 0.5, bins = 15, color="grey70") +
+                    if (nrow(plot_data_filtered) > density_min_cells) {
+                        # contours only need the density, so estimate it from a sample of cells
+                        density_df <- plot_data_filtered[, c("UMAP_1", "UMAP_2")] %>%
+                            slice_sample(n = min(density_sample, nrow(plot_data_filtered)))
+                        outline_layer <- geom_density_2d(data = density_df, aes(color = ..level..), size = 0.5, bins = 15, color="grey70")
+                    } else {
+                        # too few cells for useful contours; a light silhouette skips the KDE
+                        outline_layer <- geom_point(data = plot_data_filtered, color = "grey85", size = 0.2, alpha = 0.4)
+                    }
+                    base_umap_plot <- ggplot(mapping = aes(x = UMAP_1, y = UMAP_2)) +
+                        outline_layer +
                         scale_color_identity() +
                         coord_fixed(ratio = 1) +
                         xlim(-scale_limit, scale_limit) + ylim(-scale_limit, scale_limit) +
@@ -64,67 +61,127 @@ def generate_feature_umap_from_df(df, selected_features):
                         theme(panel.grid = element_blank(),
                             axis.title = element_text(size = 10),
                             legend.position = "none")
+                    if (length(ls(.feature_umap_base)) >= base_cache_size) {
+                        rm(list = ls(.feature_umap_base), envir = .feature_umap_base)
+                    }
+                    assign(umap_base_key, base_umap_plot, envir = .feature_umap_base)
+                }
+
+                use_scattermore <- requireNamespace("scattermore", quietly = TRUE)
+                pos_df <- as.data.frame(pos_df_arrow)
+                pos_by_gene <- split(pos_df, pos_df$Gene)
+                # one color scale across genes, so patchwork can collect a single legend
+                max_expr <- suppressWarnings(max(pos_df$Expr, na.rm = TRUE))
+                if (!is.finite(max_expr) || max_expr <= 0) max_expr <- 1
+
+                plot_list <- lapply(gene_cols, function(singleFeature) {
+                    expressing_cells <- pos_by_gene[[singleFeature]]
+
+                    # Rasterize the expressing cells in C; fall back to vector points
+                    if (use_scattermore) {
+                        point_layer <- scattermore::geom_scattermore(data = expressing_cells,
+                                aes(color = Expr),
+                                pointsize = 1.2, pixels = c(600, 600))
+                    } else {
+                        point_layer <- geom_point(data = expressing_cells,
+                                aes(color = Expr),
+                                size = 0.2, alpha = 1)
+                    }
+
+                    gg <- base_umap_plot +
+                        point_layer +
+                        scale_color_gradient(low = "lightyellow", high = "red",
+                                            limits = c(0, max_expr), oob = scales::squish) +
+                        labs(title = singleFeature, color = "Expr.") +
+                        theme(legend.position = "right",
+                            legend.title = element_text(size = 9),
+                            legend.text = element_text(size = 8),
+                            legend.key.size = unit(0.4, 'cm'),
+                            plot.title = element_text(hjust = 0.5, face = "bold"))
+                    return(gg)
+                })
+                final_plot <- patchwork::wrap_plots(plot_list, ncol = min(4, length(plot_list)), guides = "collect")
+            } else {
+                # fallback: cluster coloring
+                scale_limit <- ceiling(max(abs(plot_data_filtered[, c("UMAP_1", "UMAP_2")]), na.rm=TRUE))
+                final_plot <- ggplot(data = plot_data_filtered, aes(x = UMAP_1, y = UMAP_2)) +
+                    geom_point(aes(color = CellType_Level3), size = 0.4, alpha = 0.8) +
+                    labs(x = "UMAP1", y = "UMAP2", title = "Clusters", color = "CellType") +
+                    coord_fixed(ratio = 1) +
+                    xlim(-scale_limit, scale_limit) + ylim(-scale_limit, scale_limit) +
+                    theme_bw() +
+                    guides(colour = guide_legend(override.aes = list(size = 3)))
+            }
+
+            # --- Save plot ---
+            plot_width <- 10
+            plot_height <- if (length(gene_cols) > 0) max(4, 2.5 * ceiling(length(gene_cols) / min(4, length(gene_cols)))) else 6
+
+            png_raw <- .ggsave_raw(final_plot, width = plot_width, height = plot_height,
+                                   dpi = 150, limitsize = FALSE)
+
+            # End timing
+            end_time <- Sys.time()
+            cat("Feature UMAP Computation time: ", round(end_time - save_start, 3), " sec\\n")
+            png_raw
+        }))
+    })
+""")
 
-                    plot_list <- lapply(gene_cols, function(singleFeature) {{
-                        expressing_cells <- plot_data_filtered %>%
-                            filter(!is.na(.data[[singleFeature]]) & .data[[singleFeature]] > 0)
-
-                        max_expr <- max(expressing_cells[[singleFeature]], 0, na.rm = TRUE)
-                        if (is.na(max_expr) || max_expr <= 0) max_expr <- 1
-
-                        gg <- base_umap_plot +
-                            geom_point(data = expressing_cells,
-                                    aes(color = .data[[singleFeature]]),
-                                    size = 0.2, alpha = 1) +
-                            scale_color_gradient(low = "lightyellow", high = "red",
-                                                limits = c(0, max_expr), oob = scales::squish) +
-                            labs(title = singleFeature, color = "Expr.") +
-                            theme(legend.position = "right",
-                                legend.title = element_text(size = 9),
-                                legend.text = element_text(size = 8),
-                                legend.key.size = unit(0.4, 'cm'),
-                                plot.title = element_text(hjust = 0.5, face = "bold"))
-                        return(gg)
-                    }})
-                    final_plot <- patchwork::wrap_plots(plot_list, ncol = min(4, length(plot_list)))
-                }} else {{
-                    # fallback: cluster coloring
-                    scale_limit <- ceiling(max(abs(plot_data_filtered[, c("UMAP_1", "UMAP_2")]), na.rm=TRUE))
-                    final_plot <- ggplot(data = plot_data_filtered, aes(x = UMAP_1, y = UMAP_2)) +
-                        geom_point(aes(color = CellType_Level3), size = 0.4, alpha = 0.8) +
-                        labs(x = "UMAP1", y = "UMAP2", title = "Clusters", color = "CellType") +
-                        coord_fixed(ratio = 1) +
-                        xlim(-scale_limit, scale_limit) + ylim(-scale_limit, scale_limit) +
-                        theme_bw() +
-                        guides(colour = guide_legend(override.aes = list(size = 3)))
-                }}
-
-                # --- Save plot ---
-                plot_width <- 10
-                plot_height <- if (length(gene_cols) > 0) max(4, 2.5 * ceiling(length(gene_cols) / min(4, length(gene_cols)))) else 6
-
-                ggsave("{tmp_path_r}", plot = final_plot,
-                    width = plot_width, height = plot_height,
-                    dpi = 150, limitsize = FALSE)
-                
-                # End timing
-                end_time <- Sys.time()
-                cat("Feature UMAP Computation time: ", round(end_time - save_start, 3), " sec\n")
-            }}))
-        """
-        ro.r(r_code)
-
-        # Encode and return
-        with open(tmp_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
-        return f"data:image/png;base64,{encoded_image}", []
+def generate_feature_umap_from_df(df, selected_features):
+    """
+    Generate UMAP plots (colored by gene expression or clusters)
+    directly from a pre-loaded pandas DataFrame. All gene panels share one
+    expression color scale (0 to the highest selected value), so a single
+    collected legend is drawn for the whole grid.
+    """
+    try:
+        gene_cols = [g for g in selected_features if g in df.columns]
+        meta_cols = [c for c in ["UMAP_1", "UMAP_2", "CellType_Level3"] if c in df.columns]
+
+        # Identical inputs (re-navigation, toggling back) are served from the PNG cache
+        cache_key = png_cache_key("feature_umap", frame_fingerprint(df[meta_cols + gene_cols]), tuple(gene_cols))
+        cached_png = png_cache_get(cache_key)
+        if cached_png is not None:
+            return png_data_uri(cached_png), []
+
+        # Pass the coordinates to R through Arrow; Barcode/Subject/Status are never used here
+        plot_data_r = df_to_r_arrow(df.loc[:, meta_cols])
+
+        # Expressing cells for every gene in one long table, scanned once here instead of
+        # filtered per gene in R; float32 halves the bytes handed over
+        pos_df = df.melt(id_vars=["UMAP_1", "UMAP_2"], value_vars=gene_cols, var_name="Gene", value_name="Expr")
+        pos_df = pos_df[pos_df["Expr"] > 0].astype({"Expr": "float32"})
+        pos_df["Gene"] = pd.Categorical(pos_df["Gene"], categories=gene_cols)
+        pos_df_r = df_to_r_arrow(pos_df)
+
+        # The base plot depends only on the cell coordinates, so toggling genes reuses it
+        umap_base_key = frame_fingerprint(df[["UMAP_1", "UMAP_2"]])
+
+        png_raw = ro.globalenv[".render_feature_umap"](
+            plot_data_r, pos_df_r, ro.StrVector(gene_cols), umap_base_key,
+            UMAP_DENSITY_SAMPLE, UMAP_DENSITY_MIN_CELLS, UMAP_BASE_CACHE_SIZE,
+        )
+
+        # PNG bytes come back as an R raw vector; no temp file on the Python side
+        png_bytes = bytes(png_raw)
+        png_cache_put(cache_key, png_bytes)
+        return png_data_uri(png_bytes), []
 
     except Exception as e:
         print(f"--- ERROR generating feature UMAP from df ---\\n{e}")
         return "/assets/error_placeholder.png", [str(e)]
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
+
+def _feature_umap_task(df_ipc, selected_features):
+    """Worker-side entry: rebuilds the frame from Arrow IPC and renders in the worker's R."""
+    return generate_feature_umap_from_df(ipc_to_df(df_ipc), selected_features)
+
+def submit_feature_umap(df, selected_features):
+    """
+    Queues the feature UMAP on the R worker pool and returns a Future of (src, messages),
+    so it renders alongside the heatmap and dot plot. Only the coordinates, cell type and
+    selected genes are serialized, as Arrow IPC with the gene columns narrowed.
+    """
+    keep = ["UMAP_1", "UMAP_2", "CellType_Level3", *selected_features]
+    df = narrow_columns(df.loc[:, [c for c in keep if c in df.columns]], selected_features)
+    return submit_r_task(_feature_umap_task, df_to_ipc(df), list(selected_features))
@@ -1,160 +1,157 @@
 # utils/run_r_violin_plot.py
 
-import base64
-import os
-import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
-from utils.db_connection import dict_to_r_vector
+from utils.helper import frame_fingerprint
+from utils.png_cache import png_cache_get, png_cache_key, png_cache_put
+from utils.r_utils import df_to_r_arrow, no_data_png, png_data_uri, r_named_colors
+
+VIOLIN_MAX_ROWS = 10000 # Long-format (cell x gene) rows drawn by the violin plot
+STATUS_LEVELS = ["Prior", "Lesion", "Post"]
+
+# One-time R setup: packages are attached and the render function is compiled at import,
+# so each call only passes its inputs instead of re-parsing the script
+ro.r("""
+    suppressPackageStartupMessages({
+        library(ggplot2)
+        library(dplyr)
+        library(arrow)
+        library(ragg)
+    })
+
+    .render_violin <- compiler::cmpfun(function(exp_meta_arrow, median_arrow, CellType_color) {
+        # Suppressing warnings speeds up execution by preventing console I/O lag
+        suppressWarnings(suppressMessages({
+            save_start <- Sys.time()
+            cat("--- R Violin Plot: Script execution started ---\\n", file=stderr())
+            exp_meta_df_reshape <- as.data.frame(exp_meta_arrow) %>% droplevels()
+            median_df <- as.data.frame(median_arrow) %>% droplevels()
+
+            # plotting: each facet is gene by cluster, x is status, y is exp value,
+            g = ggplot(data = exp_meta_df_reshape,
+                    aes(x = Status, y = Exp, fill = CellType_Level3)) +
+            geom_violin(scale = 'width',
+                        trim = TRUE,
+                        draw_quantiles = c(0.25, 0.5, 0.75),
+                        color = 'black',
+                        size = 0.3,
+                        alpha = 0.8) +
+            geom_pointrange(data = median_df, aes(x = Status, y = Exp, ymin = Exp, ymax = Exp),
+                            color = "black", size = 0.2, inherit.aes = FALSE) +
+            geom_line(data = median_df, aes(x = Status, y = Exp, group = 1), color = "black", inherit.aes = FALSE) +
+            scale_fill_manual(values = CellType_color) +
+            # x is always Prior/Lesion/Post, so only y is trained per gene row;
+            # wrap only the strip labels, not every row of the long table
+            facet_grid(Gene ~ CellType_Level3, scales = "free_y", switch = "y",
+                       labeller = labeller(CellType_Level3 = function(x) gsub(" ", "\\n", x))) +
+            theme_bw() +
+            theme(
+                panel.spacing = unit(0.05, "lines"),
+                panel.grid = element_blank(),
+                strip.background = element_blank(),
+                strip.text.x = element_text(size = 15, angle = 0, face = "plain", hjust = 0.5),
+                strip.text.y.left = element_text(size = 15, angle = 0, face = "plain", hjust = 0.5),
+                strip.placement = "outside",
+                axis.title.x = element_text(size = 0, color = 'black'),
+                axis.title.y = element_text(size = 15, color = 'black'),
+                axis.text.x = element_text(size = 15, color = 'black', angle = 90, hjust = 1, vjust = 0.5),
+                axis.text.y = element_text(size = 15, color = 'black'),
+                legend.position = "none"
+            ) +
+            labs(y = 'Log Normalized Expression')
+
+            # --- Save plot safely ---
+            n_genes = length(unique(exp_meta_df_reshape$Gene))
+            n_cell_types = length(unique(exp_meta_df_reshape$CellType_Level3))
+
+            width_factor = 2.0
+            height_factor = 2.0
+
+            # Enforce minimums to prevent blur/stretch on small data
+            final_w = max(4, n_cell_types * width_factor)
+            final_h = max(3, n_genes * height_factor)
+
+            png_raw <- .ggsave_raw(g, width = final_w, height = final_h, dpi = 300, limitsize = FALSE)
+
+            end_time <- Sys.time()
+            cat("Violin Plot Computation time: ", round(end_time - save_start, 3), " sec\\n")
+            png_raw
+        })) # End suppressWarnings
+    })
+""")
+
+def _dictionary_array(codes, levels):
+    """Builds an Arrow dictionary column (an R factor) from integer codes; -1 becomes NA."""
+    codes = np.asarray(codes, dtype=np.int32)
+    return pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0), pa.array(levels, type=pa.string()))
 
 def generate_violin_plot_from_df(df, color_file, selected_features):
     """
-    Generate a violin plot using the R computeViolinPlot() function from a pandas DataFrame.
+    Generate a violin plot using the R .render_violin() function from a pandas DataFrame.
     """
-    tmp_path = ""
     try:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
-            tmp_path = tmp.name
-        tmp_path_r = tmp_path.replace("\\", "/")
-
-        r_color_string = dict_to_r_vector(color_file)
-
-        # Pass the dataframe to R
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            ro.globalenv["plot_data_filtered"] = df
-            # ro.globalenv["color_file"] = color_file
-            ro.globalenv['selected_features_r'] = ro.StrVector(selected_features)
-
-        # color_file_r = color_file.replace("\\", "/")
-
-        r_code = f"""
-            suppressPackageStartupMessages({{
-                library(ggplot2)
-                library(dplyr)
-                library(data.table)
-                library(jsonlite) 
-                library(svglite)
-                library(ragg)
-            }})
-            
-            # Suppressing warnings speeds up execution by preventing console I/O lag
-            suppressWarnings(suppressMessages({{
-            
-                save_start <- Sys.time()
-                cat("--- R Violin Plot: Script execution started ---\\n", file=stderr())
-                
-                CellType_color <- {r_color_string}
-                if (is.list(CellType_color)) {{
-                    CellType_color <- unlist(CellType_color)
-                }}
-                names(CellType_color) <- gsub(" ", "\n", names(CellType_color))
-
-                # --- Determine genes available for plotting ---
-                gene_cols <- setdiff(colnames(plot_data_filtered),
-                                    c("Barcode", "UMAP_1", "UMAP_2", "CellType_Level3", "Subject", "Status"))
-                cat(paste0("   Genes available for plotting: ", paste(gene_cols, collapse=", "), "\\n"), file=stderr())
-
-                selectedFeature = selected_features_r
-                if (length(selectedFeature) > 0) {{
-                    gene_cols <- intersect(selectedFeature, gene_cols)
-                }}
-
-                # reorder genes to match selectedFeature order
-                gene_cols <- gene_cols[match(gene_cols, selectedFeature)]
-
-                # Bail out early if nothing to plot
-                if (length(gene_cols) == 0) {{
-                    p_out <- ggplot() + annotate("text", x=0.5, y=0.5, label="No data for filter selection") + theme_void()
-                    ggsave("{tmp_path_r}", plot = p_out, width = 6, height = 4, dpi = 150)
-                    stop("No data remaining after filtering.", call. = FALSE)
-                }}
-
-                # --- Generate Violin Plot ---
-                exp_meta_df_reshape <- as.data.table(
-                    plot_data_filtered[, !colnames(plot_data_filtered) %in% c("Subject", "Barcode", "UMAP_1", "UMAP_2"), drop = FALSE]
-                )
-
-                exp_meta_df_reshape <- data.table::melt(
-                    exp_meta_df_reshape,
-                    id.vars = c("CellType_Level3", "Status"),
-                    variable.name = "Gene",
-                    value.name = "Exp"
-                )
-
-                exp_meta_df_reshape$Exp = as.numeric(exp_meta_df_reshape$Exp)
-                exp_meta_df_reshape$CellType_Level3 <- gsub(" ", "\n", exp_meta_df_reshape$CellType_Level3)
-                
-                # change gene name order (optional), prior data already done, but confirm
-                exp_meta_df_reshape$CellType_Level3 = factor(exp_meta_df_reshape$CellType_Level3, levels = names(CellType_color))
-                exp_meta_df_reshape$Status = factor(exp_meta_df_reshape$Status, levels = c("Prior", "Lesion", "Post"))
-                exp_meta_df_reshape$Gene = factor(exp_meta_df_reshape$Gene, levels = gene_cols)
-                exp_meta_df_reshape = exp_meta_df_reshape %>% droplevels()
-
-                # plotting: each facet is gene by cluster, x is status, y is exp value,
-                if (nrow(exp_meta_df_reshape) > 10000) {{
-                exp_meta_df_reshape <- exp_meta_df_reshape[sample(.N, 10000)]
-                message("Downsampled to 10k rows for faster violin rendering")
-                }}
-
-                g = ggplot(data = exp_meta_df_reshape,
-                        aes(x = Status, y = Exp, fill = CellType_Level3)) +
-                geom_violin(scale = 'width',
-                            trim = TRUE,
-                            draw_quantiles = c(0.25, 0.5, 0.75),
-                            color = 'black',
-                            size = 0.3,
-                            alpha = 0.8) +
-                stat_summary(fun = median, geom = "pointrange", color = "black", size = 0.2) +
-                stat_summary(fun = median, geom = "line", color = "black", aes(group = 1)) +
-                scale_fill_manual(values = CellType_color) +
-                facet_grid(Gene ~ CellType_Level3, scales = "free_x") +
-                theme_bw() +
-                theme(
-                    panel.spacing = unit(0.05, "lines"),
-                    panel.grid = element_blank(),
-                    strip.background = element_blank(),
-                    strip.text.x = element_text(size = 15, angle = 0, face = "plain", hjust = 0.5),
-                    strip.text.y = element_text(size = 15, angle = 0, face = "plain", hjust = 0.5),
-                    axis.title.x = element_text(size = 0, color = 'black'),
-                    axis.title.y = element_text(size = 15, color = 'black'),
-                    axis.text.x = element_text(size = 15, color = 'black', angle = 90, hjust = 1, vjust = 0.5),
-                    axis.text.y = element_text(size = 15, color = 'black'),
-                    legend.position = "none"
-                ) +
-                labs(y = 'Log Normalized Expression')
-
-                # --- Save plot safely ---
-                n_genes = length(unique(exp_meta_df_reshape$Gene))
-                n_cell_types = length(unique(exp_meta_df_reshape$CellType_Level3))
-
-                width_factor = 2.0
-                height_factor = 2.0
-                    
-                # Enforce minimums to prevent blur/stretch on small data
-                final_w = max(4, n_cell_types * width_factor)
-                final_h = max(3, n_genes * height_factor)
-
-                ggsave("{tmp_path_r}", plot = g, device = "png", width = final_w, height = final_h, dpi = 300, limitsize = FALSE)
-
-                end_time <- Sys.time()
-                cat("Violin Plot Computation time: ", round(end_time - save_start, 3), " sec\n")
-        }}) # End suppressWarnings
+        genes = [g for g in selected_features if g in df.columns]
+        if not genes:
+            return no_data_png(6, 4, 150), []
+
+        # Identical inputs (re-navigation, toggling back) are served from the PNG cache
+        cache_key = png_cache_key("violin", frame_fingerprint(df[["CellType_Level3", "Status", *genes]]),
+                                  tuple(genes), tuple((color_file or {}).items()))
+        cached_png = png_cache_get(cache_key)
+        if cached_png is not None:
+            return png_data_uri(cached_png), []
+
+        # Downsample cells before the reshape so only ~10k long rows are built
+        target_rows = max(VIOLIN_MAX_ROWS // len(genes), 500)
+        if len(df) > target_rows:
+            df = df.sample(n=target_rows, random_state=42)
+
+        if isinstance(color_file, dict) and color_file:
+            celltype_levels = list(color_file)
+        else:
+            celltype_levels = sorted(df["CellType_Level3"].dropna().astype(str).unique())
+
+        # Long format built straight from the (cells x genes) block: genes are stacked
+        # column-major and every label is a dictionary (R factor) code, so no per-row
+        # strings are materialized
+        vals = df[genes].to_numpy(dtype=np.float32)
+        n_cells, n_genes = vals.shape
+        gene_codes = np.repeat(np.arange(n_genes, dtype=np.int32), n_cells)
+        ct_codes = np.tile(pd.Index(celltype_levels).get_indexer(df["CellType_Level3"].astype(str)), n_genes)
+        status_codes = np.tile(pd.Index(STATUS_LEVELS).get_indexer(df["Status"].astype(str)), n_genes)
+        exp = vals.reshape(-1, order="F")
+
+        long_table = pa.table({
+            "CellType_Level3": _dictionary_array(ct_codes, celltype_levels),
+            "Status": _dictionary_array(status_codes, STATUS_LEVELS),
+            "Gene": _dictionary_array(gene_codes, genes),
+            "Exp": pa.array(exp),
+        })
+
+        # Medians per panel and status, computed once instead of by stat_summary in every facet
+        median_df = (pd.DataFrame({"Gene": gene_codes, "CellType_Level3": ct_codes, "Status": status_codes, "Exp": exp})
+                     .query("CellType_Level3 >= 0 and Status >= 0")
+                     .groupby(["Gene", "CellType_Level3", "Status"])["Exp"].median().reset_index())
+        median_table = pa.table({
+            "Gene": _dictionary_array(median_df["Gene"], genes),
+            "CellType_Level3": _dictionary_array(median_df["CellType_Level3"], celltype_levels),
+            "Status": _dictionary_array(median_df["Status"], STATUS_LEVELS),
+            "Exp": pa.array(median_df["Exp"].to_numpy(dtype=np.float32)),
+        })
+
+        png_raw = ro.globalenv[".render_violin"](
+            df_to_r_arrow(long_table),
+            df_to_r_arrow(median_table),
+            r_named_colors(color_file),
         )
-        """
-        ro.r(r_code)
 
-        # Encode and return
-        with open(tmp_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode()
-        return f"data:image/png;base64,{encoded_image}", []
+        # PNG bytes come back as an R raw vector; no temp file on the Python side
+        png_bytes = bytes(png_raw)
+        png_cache_put(cache_key, png_bytes)
+        return png_data_uri(png_bytes), []
 
     except Exception as e:
         print(f"--- ERROR generating Violin Plot from df ---\\n{e}")
         return "/assets/error_placeholder.png", [str(e)]
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
@@ -1,123 +1,227 @@
 # utils/run_r_spatial_deconvo.py
 
 import os
-import boto3
+import json
+import threading
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from utils.s3_utils import TRANSFER_CFG, s3_client
+from utils.bootstrap import prefetch
+import numpy as np
+import pyarrow.feather as feather
 import plotly.graph_objects as go
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
+from rpy2_arrow.arrow import rarrow_to_py_table
 
 # Load env variables
 load_dotenv()
 
-# Initialize s3 cilent
-s3_client = boto3.client('s3')
-
 # -----------------------------------------------------------------------------
-# Load Data Once at Startup
+# Load Data Once, on First Use
 # -----------------------------------------------------------------------------
 # The path to your actual R data file
 DATA_FILE = "DataWarehouse/Visium/Data__Visium_Deconvolution_Interactive.Rdata" 
 
-if not os.path.exists(DATA_FILE):
-    print(f"Local file missing: {DATA_FILE}. Attempting S3 download...")
-    
-    # 2. Attempt Download from S3
+# Feather copy of the spot table plus its cell types/colors, written after the first
+# RData load; reading it takes a fraction of the time and needs no R at all.
+# The JSON sidecar records the RData's size and mtime, so a replaced RData rebuilds it
+SPOT_FEATHER = "DataWarehouse/Visium/Res4Plot_A1.feather"
+SPOT_META_JSON = "DataWarehouse/Visium/Res4Plot_A1_meta.json"
+
+def _rdata_signature():
+    """Size and mtime of the local RData, or None when it is not on disk."""
+    try:
+        st = os.stat(DATA_FILE)
+    except OSError:
+        return None
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def _load_spot_data_feather():
+    """
+    Reads the spot table and metadata from the Feather/JSON copy; None if absent,
+    unreadable, or built from a different RData than the one on disk. Without a local
+    RData there is nothing to compare against, and the copy is used as is.
+    """
+    if not (os.path.exists(SPOT_FEATHER) and os.path.exists(SPOT_META_JSON)):
+        return None
     try:
-        # Ensure the local directory exists
-        os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
-        
-        # Get Bucket Config
-        bucket_uri = os.getenv("S3_BUCKET_URI")
-        if not bucket_uri:
-            raise ValueError("S3_BUCKET_URI not set in .env")
-            
-        bucket_name = urlparse(bucket_uri).netloc
-        # Construct Key
-        s3_key = f"Joe/HSV_Dashboard_py/{DATA_FILE}"
-        
-        print(f"Downloading from s3://{bucket_name}/{s3_key}...")
-        
-        s3 = boto3.client('s3')
-        s3.download_file(bucket_name, s3_key, DATA_FILE)
-        print("Download successful.")
-        
+        with open(SPOT_META_JSON) as f:
+            meta = json.load(f)
+        source = _rdata_signature()
+        if source is not None and meta.get("source") != source:
+            print(f"{SPOT_FEATHER} is out of date with {DATA_FILE}; rebuilding from RData.")
+            return None
+        spots = feather.read_table(SPOT_FEATHER).to_pandas()
+        print(f"Loaded Visium spot table from {SPOT_FEATHER}")
+        return spots, meta["cell_type_names"], meta["colors"]
     except Exception as e:
-        print(f"Failed to download S3 file: {e}")
-
-# 3. Final Validation
-if not os.path.exists(DATA_FILE):
-    raise FileNotFoundError(f"CRITICAL: Data file could not be found locally or downloaded from S3: {DATA_FILE}")
-        
-# Normalize slashes for R
-data_file_r = DATA_FILE.replace("\\", "/")
-
-# Load the Rdata file into the rpy2 environment
-ro.r(f'''
-suppressMessages({{
-  suppressWarnings({{
-    load("{data_file_r}")
-  }})
-}})
-''')
-
-# Convert the R objects to Python objects
-with localconverter(ro.default_converter + pandas2ri.converter):
-    Res4Plot_A1 = ro.r['Res4Plot_A1']
-    cell_type_names_A1 = list(ro.r['cell_type_names_A1'])
+        print(f"Could not read {SPOT_FEATHER} ({e}); falling back to RData.")
+        return None
+
+def download_deconvo_rdata():
+    """Downloads the deconvolution RData from S3 when it is not on disk; failures are logged."""
+    if not os.path.exists(DATA_FILE):
+        print(f"Local file missing: {DATA_FILE}. Attempting S3 download...")
+
+        # 2. Attempt Download from S3
+        try:
+            # Ensure the local directory exists
+            os.makedirs(os.path.dirname(DATA_FILE), exist_ok=True)
+
+            # Get Bucket Config
+            bucket_uri = os.getenv("S3_BUCKET_URI")
+            if not bucket_uri:
+                raise ValueError("S3_BUCKET_URI not set in .env")
+
+            bucket_name = urlparse(bucket_uri).netloc
+            # Construct Key
+            s3_key = f"Joe/HSV_Dashboard_py/{DATA_FILE}"
+
+            print(f"Downloading from s3://{bucket_name}/{s3_key}...")
+
+            # The shared client is thread-safe; this runs on the prefetch pool
+            s3_client.download_file(bucket_name, s3_key, DATA_FILE, Config=TRANSFER_CFG)
+            print("Download successful.")
+
+        except Exception as e:
+            print(f"Failed to download S3 file: {e}")
+
+def _load_spot_data_rdata():
+    """Loads the spot table from the RData file (downloading it if needed), then writes the Feather copy."""
+    prefetch(download_deconvo_rdata).result()
+
+    # 3. Final Validation
+    if not os.path.exists(DATA_FILE):
+        raise FileNotFoundError(f"CRITICAL: Data file could not be found locally or downloaded from S3: {DATA_FILE}")
+
+    # Normalize slashes for R
+    data_file_r = DATA_FILE.replace("\\", "/")
+
+    # Load the Rdata file into the rpy2 environment
+    ro.r(f'''
+    suppressMessages({{
+      suppressWarnings({{
+        load("{data_file_r}")
+      }})
+    }})
+    ''')
+
+    # Convert the R objects to Python objects. The spot table crosses as an Arrow table
+    # (shared buffers) rather than through pandas2ri's column-by-column conversion
+    ro.r('suppressPackageStartupMessages(library(arrow))')
+    spots_table = rarrow_to_py_table(ro.r('arrow::as_arrow_table(Res4Plot_A1)'))
+    cell_type_names = list(ro.r['cell_type_names_A1'])
     # R named vectors need to be converted to Python dicts
     colors_r = ro.r['colors']
-    colors = {name: colors_r.rx(name)[0] for name in colors_r.names}
+    color_map = dict(zip(colors_r.names, colors_r))
+
+    try:
+        feather.write_feather(spots_table, SPOT_FEATHER)
+        with open(SPOT_META_JSON, "w") as f:
+            json.dump({"cell_type_names": cell_type_names, "colors": color_map,
+                       "source": _rdata_signature()}, f)
+    except Exception as e:
+        print(f"Could not write Feather spot table: {e}")
+
+    return spots_table.to_pandas(), cell_type_names, color_map
 
 # -----------------------------------------------------------------------------
+FIG_WIDTH = 1000
+FIG_HEIGHT = 800
+FIG_MARGIN = dict(t=5, b=20, l=20, r=20)
+PIE_SIZE = 0.02 # relative size of each pie
+PIE_ARC_POINTS = 24 # vertices per slice arc
+
+_spot_data = None
+_spot_data_lock = threading.Lock()
+
+def _get_spot_data():
+    """
+    Loads the spot table on first use (not at import, so R pool workers that re-import the
+    app never load it) and computes slice fractions and start angles (as fractions of a
+    turn) once for every spot with NumPy. Later calls return the same dict.
+    """
+    global _spot_data
+    if _spot_data is None:
+        with _spot_data_lock:
+            if _spot_data is None:
+                spots, cell_type_names, color_map = _load_spot_data_feather() or _load_spot_data_rdata()
+                values = spots[cell_type_names].to_numpy(dtype=float)
+                totals = values.sum(axis=1, keepdims=True)
+                fractions = np.divide(values, totals, out=np.zeros_like(values), where=totals > 0)
+                _spot_data = {
+                    "spots": spots,
+                    "cell_type_names": cell_type_names,
+                    "colors": color_map,
+                    "fractions": fractions,
+                    "starts": np.cumsum(fractions, axis=1) - fractions,
+                    "x": spots["imagecol"].to_numpy(dtype=float)[:, None],
+                    "y": spots["imagerow"].to_numpy(dtype=float)[:, None],
+                }
+    return _spot_data
+
 def run_r_spatial_deconvo():
     """
     Generate Visium deconvolution pie plots from pre-loaded data.
     """
+    data = _get_spot_data()
+    spots, colors = data["spots"], data["colors"]
     fig = go.Figure()
 
     # Compute axis limits
-    x_min = Res4Plot_A1["imagecol"].min() - 55
-    x_max = Res4Plot_A1["imagecol"].max() + 55
-    y_min = Res4Plot_A1["imagerow"].max() + 55
-    y_max = Res4Plot_A1["imagerow"].min() - 55
-
-    pie_size = 0.02  # relative size of each pie
-
-    # Add pie charts for each row
-    for idx, row in Res4Plot_A1.iterrows():
-        pie_values = row[cell_type_names_A1].values
-        pie_labels = cell_type_names_A1
-
-        # Only include non-zero slices
-        non_zero_idx = [i for i, v in enumerate(pie_values) if v > 0]
-        if non_zero_idx:
-            fig.add_trace(go.Pie(
-                labels=[pie_labels[i] for i in non_zero_idx],
-                values=[pie_values[i] for i in non_zero_idx],
-                marker=dict(colors=[colors.get(pie_labels[i]) for i in non_zero_idx]),
-                textinfo="none",
-                hoverinfo="label+percent",
-                domain=dict(
-                    x=[(row.imagecol - x_min)/(x_max - x_min) - pie_size,
-                       (row.imagecol - x_min)/(x_max - x_min) + pie_size],
-                    y=[(row.imagerow - y_min)/(y_max - y_min) - pie_size,
-                       (row.imagerow - y_min)/(y_max - y_min) + pie_size]
-                ),
-                showlegend=False
-            ))
+    x_min = spots["imagecol"].min() - 55
+    x_max = spots["imagecol"].max() + 55
+    y_min = spots["imagerow"].max() + 55
+    y_max = spots["imagerow"].min() - 55
+
+    # Each pie spans about 2 * PIE_SIZE of the smaller plot dimension, as the old per-spot
+    # go.Pie domains did. The y axis is locked to the x scale (scaleanchor), so one radius
+    # in data units draws round pies whatever space the legend takes
+    plot_w = FIG_WIDTH - FIG_MARGIN["l"] - FIG_MARGIN["r"]
+    plot_h = FIG_HEIGHT - FIG_MARGIN["t"] - FIG_MARGIN["b"]
+    radius_px = PIE_SIZE * min(plot_w, plot_h)
+    rx = ry = radius_px * (x_max - x_min) / plot_w
+
+    fractions, starts = data["fractions"], data["starts"]
+    cx, cy = data["x"], data["y"]
+    t = np.linspace(0.0, 1.0, PIE_ARC_POINTS)[None, :]
+
+    # Slices run clockwise from 12 o'clock like go.Pie.
+    # One WebGL trace per cell type: every spot's wedge is a closed polygon
+    # (center, arc, center) and wedges are separated by NaN gaps
+    for k, cell_type in enumerate(data["cell_type_names"]):
+        keep = fractions[:, k] > 0
+        if not keep.any():
+            continue
+        theta = np.pi / 2 - 2 * np.pi * (starts[keep, k:k + 1] + fractions[keep, k:k + 1] * t)
+        n = int(keep.sum())
+        xs = np.hstack([cx[keep], cx[keep] + rx * np.cos(theta), cx[keep], np.full((n, 1), np.nan)])
+        ys = np.hstack([cy[keep], cy[keep] - ry * np.sin(theta), cy[keep], np.full((n, 1), np.nan)])
+        pct = np.repeat(fractions[keep, k], xs.shape[1])
+        fig.add_trace(go.Scattergl(
+            x=xs.ravel(),
+            y=ys.ravel(),
+            mode="lines",
+            fill="toself",
+            fillcolor=colors.get(cell_type),
+            line=dict(width=0, color=colors.get(cell_type)),
+            name=cell_type,
+            customdata=pct,
+            hovertemplate="%{fullData.name}: %{customdata:.1%}<extra></extra>",
+        ))
 
     # Layout
     fig.update_layout(
         title="",
         xaxis=dict(title="Image Column", range=[x_min, x_max], zeroline=False, showgrid=False),
-        yaxis=dict(title="Image Row", range=[y_max, y_min], zeroline=False, showgrid=False, autorange="reversed"),
+        # Image rows grow downwards: the reversed range is given explicitly, since
+        # autorange="reversed" would override it and pad the axis
+        yaxis=dict(title="Image Row", range=[y_min, y_max], zeroline=False, showgrid=False,
+                   scaleanchor="x", scaleratio=1),
         showlegend=True,
-        width=1000,
-        height=800,
-        margin=dict(t=5, b=20, l=20, r=20),
+        width=FIG_WIDTH,
+        height=FIG_HEIGHT,
+        margin=FIG_MARGIN,
         plot_bgcolor='white',
         paper_bgcolor='white'
     )
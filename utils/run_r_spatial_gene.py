@@ -1,17 +1,20 @@
 # utils/run_r_spatial_gene.py
 
+import json
 import os
-import base64
 import re
+import threading
 import time
-import boto3
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+from utils.s3_utils import TRANSFER_CFG, s3_client
+from utils.bootstrap import prefetch
+from utils.helper import file_signature
 from dash import html
 
 import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
+from utils.r_utils import png_data_uri
+from utils.png_cache import png_cache_has, png_cache_key, png_cache_put, png_cache_url
 
 # Load environment variables
 load_dotenv()
@@ -19,15 +22,15 @@ load_dotenv()
 # --- 1. DATA LOADING INFRASTRUCTURE ---
 DATA_RELATIVE_PATH = "DataWarehouse/Visium/HSV434-Visium-A1_sub_label.Rdata"
 
+LOCAL_DATA_PATH = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), DATA_RELATIVE_PATH)
+
 def ensure_visium_data_exists():
     """
     Checks if the RData file exists locally. 
     If not, downloads it from S3 (ECS/New Environment support).
     Returns the R-compatible absolute path.
     """
-    # Define paths
-    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    full_local_path = os.path.join(project_root, DATA_RELATIVE_PATH)
+    full_local_path = LOCAL_DATA_PATH
 
     # Check existence
     if not os.path.exists(full_local_path):
@@ -49,9 +52,8 @@ def ensure_visium_data_exists():
             # Construct S3 Key
             s3_key = f"Joe/HSV_Dashboard_py/{DATA_RELATIVE_PATH}"
 
-            # Download
-            s3 = boto3.client('s3')
-            s3.download_file(bucket_name, s3_key, full_local_path)
+            # Download (the shared client is thread-safe; this runs on the prefetch pool)
+            s3_client.download_file(bucket_name, s3_key, full_local_path, Config=TRANSFER_CFG)
             
             print(f"Download complete in {time.time() - start_ts:.2f}s")
 
@@ -63,50 +65,115 @@ def ensure_visium_data_exists():
     return full_local_path.replace("\\", "/")
 
 # --- 2. INITIALIZE R ENVIRONMENT ---
-# Get the valid data path
-try:
-    R_DATA_PATH = ensure_visium_data_exists()
-except Exception as e:
-    print(f"Error initializing Spatial Data: {e}")
-    R_DATA_PATH = None
-
-# Load necessary R libraries
-ro.r('''
-suppressMessages({
-  suppressPackageStartupMessages({
-    suppressWarnings({
-      library(Seurat)
-      library(SeuratObject)
-      library(sp)
-      library(ggplot2)
-      library(cowplot)
-    })
-  })
-})
-''')
+_r_env = None
+_r_env_lock = threading.Lock()
+
+def _ensure_r_env():
+    """
+    Returns (UPPER_TO_ORIGINAL_CASE_MAP, SCT_EXPRESSED_GENES, data signature), building
+    the R environment on the first spatial gene request. Embedded R is not thread-safe,
+    so concurrent first requests wait on a lock and only one of them runs _init_r_env.
+    A failed setup returns None and is not remembered, so the next request tries again.
+    """
+    global _r_env
+    if _r_env is None:
+        with _r_env_lock:
+            if _r_env is None:
+                try:
+                    _r_env = _init_r_env()
+                except Exception as e:
+                    print(f"Error initializing Spatial Data: {e}")
+                    return None
+    return _r_env
+
+def _load_a1_sub(r_data_path):
+    """
+    Loads A1_sub into R. An uncompressed RDS copy next to the RData is read instead when
+    its sidecar matches the RData's size and mtime; otherwise (missing, stale, or
+    unreadable) the RData is loaded and the RDS rewritten. The RDS is written to a temp
+    file and renamed, so a worker killed mid-write never leaves a truncated copy behind.
+    """
+    rds_path = os.path.splitext(r_data_path)[0] + ".rds"
+    sig_path = rds_path + ".json"
+    source = file_signature(r_data_path)
 
-# Load the Visium dataset
-if R_DATA_PATH:
-    print(f"R is loading data from: {R_DATA_PATH}")
+    try:
+        with open(sig_path) as f:
+            rds_source = json.load(f)
+    except (OSError, ValueError):
+        rds_source = None
+    if rds_source == source and os.path.exists(rds_path):
+        try:
+            print(f"R is loading data from: {rds_path}")
+            ro.r(f'A1_sub <- readRDS("{rds_path}")')
+            return
+        except Exception as e:
+            print(f"Could not read {rds_path} ({e}); loading the RData instead.")
+
+    print(f"R is loading data from: {r_data_path}")
+    ro.r(f'''
+      suppressMessages({{
+        suppressWarnings({{
+          load("{r_data_path}")
+        }})
+      }})
+    ''')
+    # Uncompressed RDS: the next start reads it back without decompressing.
+    # The temp name is per process, since several web workers may build it at once
+    tmp_path = f"{rds_path}.{os.getpid()}.tmp"
+    try:
+        ro.r(f'''
+          saveRDS(A1_sub, "{tmp_path}", compress = FALSE)
+          if (!file.rename("{tmp_path}", "{rds_path}")) stop("rename failed")
+        ''')
+        with open(sig_path, "w") as f:
+            json.dump(source, f)
+    except Exception as e:
+        print(f"Could not write A1_sub RDS cache: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _init_r_env():
+    """
+    Attaches the R libraries and loads A1_sub, so processes that never draw this plot
+    skip the Seurat start-up cost. Errors (download or R) propagate to _ensure_r_env.
+    """
+    # Get the valid data path (raises if the download failed)
+    r_data_path = prefetch(ensure_visium_data_exists).result()
 
+    # Load necessary R libraries
     ro.r('''
-      suppressMessages({
+    suppressMessages({
+      suppressPackageStartupMessages({
         suppressWarnings({
-          load("DataWarehouse/Visium/HSV434-Visium-A1_sub_label.Rdata")
+          library(Seurat)
+          library(SeuratObject)
+          library(sp)
+          library(ggplot2)
         })
       })
+    })
     ''')
 
-    # Get gene names from the SCT assay's data slot
-    original_gene_names = ro.r('rownames(A1_sub@assays$SCT$data)')
+    # Load the Visium dataset, once per R session (a Dash debug reload re-imports this module)
+    # Size/mtime of the RData A1_sub comes from; part of the plot cache key
+    data_signature = file_signature(r_data_path)
+    if "A1_sub" not in list(ro.r("ls()")):
+        _load_a1_sub(r_data_path)
+
+    # Get gene names from the SCT assay's data slot (a plain character vector, no converter)
+    original_gene_names = list(ro.r('rownames(A1_sub@assays$SCT$data)'))
 
-    # Create the mapping from an uppercase gene name to its original, correct case
-    UPPER_TO_ORIGINAL_CASE_MAP = {name.upper(): name for name in original_gene_names}
+    # Create the mapping from an uppercase gene name to its original, correct case;
+    # one probe both validates a gene case-insensitively and recovers its R name
+    upper_to_original_case_map = {name.upper(): name for name in original_gene_names}
 
-    # Create the set of uppercase names for fast, case-insensitive validation
-    AVAILABLE_GENES_UPPER = set(UPPER_TO_ORIGINAL_CASE_MAP.keys())
+    # Genes with any SCT expression, found once with a sparse row sum (no densifying), so
+    # requests for unexpressed genes are answered without a round trip into R
+    sct_expressed_genes = set(ro.r(
+        'names(which(Matrix::rowSums(GetAssayData(A1_sub, assay = "SCT", layer = "data")) > 0))'))
 
-    # Define the theme once in the global R environment
+    # Define the theme and the plotting function once in the global R environment
     ro.r("""
         spatial_feature_theme <- theme(
             plot.background = element_rect(fill = "white"),
@@ -118,13 +185,50 @@ if R_DATA_PATH:
             legend.title = element_text(size = 12),
             legend.text = element_text(size = 8)
         )
+
+        .plot_spatial_genes <- compiler::cmpfun(function(genes, plot_width, plot_height) {
+            # One call for all genes: Seurat lays the panels out itself and shares the spatial setup
+            combined_plot <- SpatialFeaturePlot(A1_sub,
+                                                features = genes,
+                                                pt.size.factor = 4,
+                                                image.alpha = 0,
+                                                stroke = NA,
+                                                alpha = 1,
+                                                max.cutoff = 'q95',
+                                                ncol = 4) &
+                spatial_feature_theme
+            # ragg device; the PNG comes back as a raw vector
+            .ggsave_raw(combined_plot, width = plot_width, height = plot_height, dpi = 150, units = "in")
+        })
     """)
-else:
-    # Fallback if data failed to load (prevents import crash, but features will fail)
-    AVAILABLE_GENES_UPPER = set()
-    UPPER_TO_ORIGINAL_CASE_MAP = {}
+
+    return upper_to_original_case_map, sct_expressed_genes, data_signature
 
 # -----------------------------------------------------------------------------
+_GENE_SPLIT = re.compile(r'[\s,;]+') # separators accepted in the gene input box
+
+def _render_spatial_genes(genes, data_signature):
+    """
+    Returns the image src for the spatial plot of genes (a tuple in original case). The
+    PNG cache on disk is the memo: it is keyed by the gene tuple and the size and mtime of
+    the RData A1_sub was loaded from, so every worker process and every re-trigger of the same list reuses one
+    rendering, and a replaced RData gets new URLs instead of stale plots.
+    """
+    cache_key = png_cache_key("spatial_gene", DATA_RELATIVE_PATH, data_signature, genes)
+    if png_cache_has(cache_key):
+        return png_cache_url(cache_key)
+
+    num_rows = -(-len(genes) // 4)
+    plot_height = max(4, 4 * num_rows)
+    plot_width = 16
+
+    # One call into the precompiled R function; genes go over as a character vector
+    # in their ORIGINAL case, and the PNG comes back as an R raw vector
+    result = ro.globalenv[".plot_spatial_genes"](ro.StrVector(genes), plot_width, plot_height)
+    if png_cache_put(cache_key, bytes(result)):
+        return png_cache_url(cache_key)
+    return png_data_uri(result)
+
 def run_r_spatial_gene(gene_names_str):
     """
     Validates gene names, then runs R SpatialFeaturePlot for valid genes.
@@ -133,77 +237,41 @@ def run_r_spatial_gene(gene_names_str):
     if not gene_names_str:
         return html.Div("Please enter at least one gene name.", style={"color": "red"}), False
 
+    r_env = _ensure_r_env()
+    if r_env is None:
+        return html.Pre("Error: The spatial dataset could not be loaded. Please try again shortly."), False
+    UPPER_TO_ORIGINAL_CASE_MAP, SCT_EXPRESSED_GENES, data_signature = r_env
+
     # Make input case-insensitive and validate against available genes
     # Split & clean
-    input_genes = [gene.strip() for gene in re.split(r'[\s,;]+', gene_names_str) if gene.strip()]
+    input_genes = [gene.strip() for gene in _GENE_SPLIT.split(gene_names_str) if gene.strip()]
 
     # Preserve input order, validate case-insensitively
     valid_genes_original_case = []
     invalid_genes_upper = []
 
     for gene in input_genes:
-        g_up = gene.upper()
-        if g_up in AVAILABLE_GENES_UPPER:
-            valid_genes_original_case.append(UPPER_TO_ORIGINAL_CASE_MAP[g_up])
+        original = UPPER_TO_ORIGINAL_CASE_MAP.get(gene.upper())
+        if original:
+            valid_genes_original_case.append(original)
         else:
-            invalid_genes_upper.append(g_up)
+            invalid_genes_upper.append(gene.upper())
 
     if not valid_genes_original_case:
         error_msg = f"Error: None of the entered genes were found. Invalid: {', '.join(invalid_genes_upper)}"
         return html.Pre(error_msg), False
 
-    # Convert valid genes back to their ORIGINAL case for R
-    r_gene_vector = 'c({})'.format(','.join([f'"{gene}"' for gene in valid_genes_original_case]))
-
-    num_rows = -(-len(valid_genes_original_case) // 4)
-    plot_height = max(4, 4 * num_rows)
-    plot_width = 16
+    # Only genes with non-zero expression can be plotted; repeats in the input (e.g. "CD3D, cd3d")
+    # collapse to one panel, so the canonical gene tuple doubles as the plot cache key
+    plottable_genes = tuple(dict.fromkeys(
+        gene for gene in valid_genes_original_case if gene in SCT_EXPRESSED_GENES))
+    if not plottable_genes:
+        unplottable = ', '.join(set(valid_genes_original_case))
+        error_msg = f"Error: The gene(s) '{unplottable}' exist but have no expression data to plot."
+        return html.Pre(error_msg), False
 
     try:
-        r_code = f"""
-
-        genes_to_check <- {r_gene_vector}
-        
-        # Check for non-zero expression in the SCT data slot
-        sct_data <- GetAssayData(A1_sub, assay = "SCT", layer = "data")[genes_to_check, , drop = FALSE]
-        plottable_genes <- names(which(rowSums(as.matrix(sct_data)) > 0))
-        
-        if (length(plottable_genes) == 0) {{
-          "NO_PLOTTABLE_GENES"
-        }} else {{
-          plot_list <- lapply(plottable_genes, function(gene) {{
-              p <- SpatialFeaturePlot(A1_sub, 
-                                      features = gene, 
-                                      pt.size.factor = 4,
-                                      image.alpha = 0, 
-                                      stroke = NA, 
-                                      alpha = 1, 
-                                      max.cutoff = 'q95') +
-                  spatial_feature_theme
-              return(p)
-          }})
-          combined_plot <- cowplot::plot_grid(plotlist = plot_list, ncol = 4)
-          tmp_path <- tempfile(fileext=".png")
-          ggsave(tmp_path, plot = combined_plot, width = {plot_width}, height = {plot_height}, units = "in", dpi = 150)
-          tmp_path
-        }}
-        """
-
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            output_path = ro.r(r_code)[0]
-
-        # Check for the special message from R
-        if output_path == "NO_PLOTTABLE_GENES":
-            unplottable = ', '.join(set(valid_genes_original_case))
-            error_msg = f"Error: The gene(s) '{unplottable}' exist but have no expression data to plot."
-            return html.Pre(error_msg), False
-
-        # proceed with creating the image
-        with open(output_path, "rb") as f:
-            encoded = base64.b64encode(f.read()).decode()
-        os.remove(output_path)
-        
-        plot_img = html.Img(src=f"data:image/png;base64,{encoded}",
+        plot_img = html.Img(src=_render_spatial_genes(plottable_genes, data_signature),
                             style={"width": "100%", "border": "1px solid #ccc"})
 
         # Show a warning for invalid ones
@@ -1,11 +1,65 @@
+import ast
+import functools
+import hashlib
 import os
 import boto3
+import pyarrow as pa
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import json
 import tempfile
 from urllib.parse import urlparse
 
-# Global S3 client
-s3_client = boto3.client("s3")
+# Global S3 client, shared by every module that talks to S3. The connection pool is
+# sized above TRANSFER_CFG.max_concurrency so parallel ranged GETs never queue for a socket
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"mode": "adaptive"},
+)
+s3_client = boto3.client("s3", config=S3_CLIENT_CONFIG)
+
+# Objects past 8 MB are fetched as parallel 16 MB ranged GETs instead of one stream
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    io_chunksize=1024 * 1024,
+    use_threads=True,
+)
+
+_S3_CACHE_DIR = os.path.join(tempfile.gettempdir(), "hsv_s3cache")
+
+def _cache_prefix(bucket, key):
+    """Stable file-name prefix for one S3 object; its cached versions all share it."""
+    return hashlib.sha1(f"{bucket}/{key}".encode("utf-8")).hexdigest()
+
+def cached_download(bucket, key, suffix=""):
+    """
+    Returns a local copy of an S3 object, cached on disk by its ETag. A HEAD request
+    checks the current ETag; the body is only downloaded (ranged, threaded GETs) when
+    that version is not cached yet. Files are written aside and moved into place, and
+    older versions of the same object are deleted so the cache does not grow.
+    """
+    etag = s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    prefix = _cache_prefix(bucket, key)
+    file_name = f"{prefix}-{etag}{suffix}"
+    path = os.path.join(_S3_CACHE_DIR, file_name)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(_S3_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.part"
+    s3_client.download_file(bucket, key, tmp_path, Config=TRANSFER_CFG)
+    os.replace(tmp_path, path)
+
+    for entry in os.scandir(_S3_CACHE_DIR):
+        if entry.name.startswith(f"{prefix}-") and entry.name != file_name and not entry.name.endswith(".part"):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return path
 
 def get_bucket():
     bucket = os.getenv("S3_BUCKET_URI")
@@ -25,12 +79,7 @@ def load_local_or_s3_parquet(local_path, bucket, key):
 
     # fallback to S3
     print(f"USING S3 FILE: s3://{bucket}/{key}")
-    obj = s3_client.get_object(Bucket=bucket, Key=key)
-    data_bytes = obj["Body"].read()
-
-    with tempfile.NamedTemporaryFile(suffix=".parquet", delete=False) as tmp:
-        tmp.write(data_bytes)
-        return tmp.name
+    return cached_download(bucket, key, suffix=".parquet")
     
 def load_s3_umap(dataset_prefix, force_s3=True):
     project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -46,13 +95,34 @@ def load_s3_umap(dataset_prefix, force_s3=True):
     key = f"Joe/HSV_Dashboard_py/DataWarehouse/UMAP/{dataset_prefix}_umap_data.parquet"
     print("DEBUG S3 KEY REQUEST:", key)
 
-    obj = s3_client.get_object(Bucket=bucket, Key=key)
-    data_bytes = obj["Body"].read()
+    # Cached local copy → ALWAYS RETURN VALID FILE PATH
+    return cached_download(bucket, key, suffix=".parquet")
+
+@functools.lru_cache(maxsize=4)
+def _arrow_s3_fs(bucket):
+    """pyarrow S3 filesystem for the bucket's region (AWS_REGION if set, else looked up once)."""
+    from pyarrow import fs as pafs
+    region = os.getenv("AWS_REGION") or pafs.resolve_s3_region(bucket)
+    return pafs.S3FileSystem(region=region)
+
+def open_s3_umap(dataset_prefix, force_s3=True):
+    """
+    Like load_s3_umap, but in S3 mode returns an Arrow random-access file on the object
+    instead of downloading it. Parquet readers then fetch only the footer and the column
+    chunks they read, as ranged GETs. A local file is memory-mapped. Either way the
+    result is a file object for use in a with block.
+    """
+    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    local_path = os.path.join(project_root, "DataWarehouse/UMAP", f"{dataset_prefix}_umap_data.parquet")
+
+    if not force_s3 and os.path.exists(local_path):
+        print(f"USING LOCAL UMAP: {local_path}")
+        return pa.memory_map(local_path)
 
-    # Write to temp file → ALWAYS RETURN VALID FILE PATH
-    with tempfile.NamedTemporaryFile(suffix=".parquet", delete=False) as tmp:
-        tmp.write(data_bytes)
-        return tmp.name
+    bucket = get_bucket()
+    key = f"Joe/HSV_Dashboard_py/DataWarehouse/UMAP/{dataset_prefix}_umap_data.parquet"
+    print(f"USING S3 UMAP (ranged reads): s3://{bucket}/{key}")
+    return _arrow_s3_fs(bucket).open_input_file(f"{bucket}/{key}")
 
 def load_s3_stats_cluster_status(dataset_prefix, force_s3=True):
     bucket = get_bucket()
@@ -73,6 +143,17 @@ def load_s3_stats_subject_status(dataset_prefix, force_s3=True):
     key = f"Joe/HSV_Dashboard_py/DataWarehouse/Stat/{dataset_prefix}_stats_subject_status.parquet"
     return load_local_or_s3_parquet(local_path, bucket, key)
 
+def _parse_colors(text):
+    """
+    Parses a color map file. Some were written as a Python dict repr ({'a': '#fff'})
+    rather than JSON. A repr can still open with a double quote (when the first name
+    holds an apostrophe), so anything JSON rejects is read as a Python literal instead.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text.strip())
+
 def load_s3_colors(dataset_prefix, force_s3=True):
     bucket = get_bucket()
     local_path = f"DataWarehouse/Color/{dataset_prefix}_colors.json"
@@ -81,18 +162,10 @@ def load_s3_colors(dataset_prefix, force_s3=True):
     # LOCAL file exists?
     if not force_s3 and os.path.exists(local_path):
         print(f"USING LOCAL COLOR JSON: {local_path}")
-        text = open(local_path).read().strip()
-        # Auto-fix Python dict
-        if text.startswith("{'"):
-            text = text.replace("'", '"')
-        return json.loads(text)
+        with open(local_path) as f:
+            return _parse_colors(f.read())
 
     # Otherwise load from S3
     print("DEBUG S3 KEY REQUEST:", key)
     obj = s3_client.get_object(Bucket=bucket, Key=key)
-    text = obj["Body"].read().decode("utf-8")
-    # Auto-fix Python dict syntax if needed
-    if text.startswith("{'"):
-        text = text.replace("'", '"')
-
-    return json.loads(text)
+    return _parse_colors(obj["Body"].read().decode("utf-8"))